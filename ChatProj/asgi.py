@@ -1,17 +1,26 @@
 # ChatProj/asgi.py
 import os
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatProj.settings')
+
+# Initialize Django before importing consumers, which import models
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from core import routing
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatProj.settings')
+from core.auth import JWTAuthMiddleware
+from core.lifespan import lifespan
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
+    "lifespan": lifespan,
     "websocket": AuthMiddlewareStack(
-        URLRouter(
-            routing.websocket_urlpatterns
+        JWTAuthMiddleware(
+            URLRouter(
+                routing.websocket_urlpatterns
+            )
         )
     ),
 })
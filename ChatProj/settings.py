@@ -46,17 +46,149 @@ MIDDLEWARE = [
 ASGI_APPLICATION = 'ChatProj.asgi.application'
 
 # settings.py
+# CHANNEL_LAYERS_HOSTS lists several Redis nodes ("redis://a:6379,redis://b:6379");
+# groups are spread over them with a consistent hash ring (core/layers.py).
+# Members in the same worker process are delivered to in memory; Redis only
+# carries one message per remote worker
+if os.getenv('CHANNEL_LAYERS_HOSTS'):
+    CHANNEL_LAYERS_HOSTS = [host.strip() for host in os.getenv('CHANNEL_LAYERS_HOSTS').split(',') if host.strip()]
+else:
+    CHANNEL_LAYERS_HOSTS = [
+        (os.getenv('CHANNEL_LAYERS_HOST', 'redis'), int(os.getenv('CHANNEL_LAYERS_PORT', 6379)))
+    ]
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'core.layers.LocalFanoutChannelLayer',
         'CONFIG': {
-            "hosts": [
-                (os.getenv('CHANNEL_LAYERS_HOST', 'redis'), int(os.getenv('CHANNEL_LAYERS_PORT', 6379)))
-            ],
+            "hosts": CHANNEL_LAYERS_HOSTS,
+            # Messages queued per channel before sends to it are refused; bounds
+            # what a consumer that stopped reading can pile up
+            "capacity": int(os.getenv('CHANNEL_LAYERS_CAPACITY', 100)),
+            "expiry": int(os.getenv('CHANNEL_LAYERS_EXPIRY', 60)),
+        },
+    },
+}
+
+# Shared asyncio Redis pool used by consumers for presence and queues
+REDIS_HOST = os.getenv('CHANNEL_LAYERS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('CHANNEL_LAYERS_PORT', 6379))
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 5))
+
+# Presence leases: connections renew every interval and count as offline after the TTL
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', 20))
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', 60))
+# Most user ids one presence request may ask about
+PRESENCE_MAX_USERS = int(os.getenv('PRESENCE_MAX_USERS', 200))
+
+# Membership notifications carry at most this many users per event
+MEMBERSHIP_EVENT_BATCH_SIZE = int(os.getenv('MEMBERSHIP_EVENT_BATCH_SIZE', 500))
+# Bulk membership endpoints: user ids accepted per request, through rows per INSERT
+MEMBERSHIP_BULK_MAX_USERS = int(os.getenv('MEMBERSHIP_BULK_MAX_USERS', 10000))
+MEMBERSHIP_BULK_BATCH_SIZE = int(os.getenv('MEMBERSHIP_BULK_BATCH_SIZE', 500))
+
+# Chat history is served in pages of message ids, newest first
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+# Unread messages sent in one batch on reconnect, read from the user's cursor
+CHAT_CATCHUP_LIMIT = int(os.getenv('CHAT_CATCHUP_LIMIT', 500))
+
+# Messages older than this move to compressed per-room segments (manage.py archive_messages)
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', 90))
+CHAT_ARCHIVE_SEGMENT_SIZE = int(os.getenv('CHAT_ARCHIVE_SEGMENT_SIZE', 1000))
+
+# Incoming frame limits, shared across workers through Redis token buckets:
+# sustained frames per second and burst size, per user and per room
+CHAT_RATE_USER = float(os.getenv('CHAT_RATE_USER', 5))
+CHAT_RATE_USER_BURST = int(os.getenv('CHAT_RATE_USER_BURST', 10))
+CHAT_RATE_ROOM = float(os.getenv('CHAT_RATE_ROOM', 50))
+CHAT_RATE_ROOM_BURST = int(os.getenv('CHAT_RATE_ROOM_BURST', 100))
+CHAT_MAX_FRAME_BYTES = int(os.getenv('CHAT_MAX_FRAME_BYTES', 16384))
+# Frames waiting to go out to one client; a client that falls this far behind
+# is disconnected and catches up from its read cursor when it reconnects. Only
+# fills on servers that push back on slow sockets; Daphne buffers without limit
+CHAT_SEND_QUEUE_SIZE = int(os.getenv('CHAT_SEND_QUEUE_SIZE', 256))
+# Messages sent past a client's last {"type": "ack"} before it is disconnected;
+# applies to clients that acknowledge, on any server
+CHAT_MAX_UNACKED = int(os.getenv('CHAT_MAX_UNACKED', 500))
+
+# Write-behind message persistence (see core/writer.py); off by default
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', 'False') == 'True'
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BEHIND_BATCH_SIZE', 500))
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.5))
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.getenv('CHAT_WRITE_BEHIND_MAX_PENDING', 10000))
+# Seconds an unflushed id holds back read cursors; only matters if its worker died
+CHAT_WRITE_BEHIND_PENDING_TTL = int(os.getenv('CHAT_WRITE_BEHIND_PENDING_TTL', 300))
+
+# Level-gated logging; LOG_LEVEL=DEBUG also logs every connect and message
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'keyvalue': {
+            'format': 'ts=%(asctime)s level=%(levelname)s logger=%(name)s pid=%(process)d %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'keyvalue',
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'WARNING',
+    },
+    'loggers': {
+        'core': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
         },
     },
 }
 
+# WebSocket handshakes may carry a JWT access token (?token=...); with
+# CHAT_WS_REQUIRE_TOKEN the user id in the URL must match a valid token
+CHAT_WS_REQUIRE_TOKEN = os.getenv('CHAT_WS_REQUIRE_TOKEN', 'False') == 'True'
+# Confirmed (user, room) memberships cached per worker for connect storms
+CHAT_AUTH_CACHE_SIZE = int(os.getenv('CHAT_AUTH_CACHE_SIZE', 10000))
+CHAT_AUTH_CACHE_TTL = float(os.getenv('CHAT_AUTH_CACHE_TTL', 30))
+
+# Seconds a session token lets a reconnecting client receive just the messages it missed
+CHAT_SESSION_MAX_AGE = int(os.getenv('CHAT_SESSION_MAX_AGE', 300))
+
+# Set by `manage.py runworkers` for each Daphne process it starts
+CHAT_WORKER_ID = os.getenv('CHAT_WORKER_ID', '')
+# A drained worker closes its sockets at random points over CHAT_DRAIN_WINDOW
+# seconds and tells each client to wait up to CHAT_RECONNECT_JITTER more
+CHAT_DRAIN_WINDOW = float(os.getenv('CHAT_DRAIN_WINDOW', 10))
+CHAT_RECONNECT_JITTER = float(os.getenv('CHAT_RECONNECT_JITTER', 3))
+
+# Bearer token for /metrics scrapers; without one only staff users may read it
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Shared response cache; with several workers set CACHE_URL (redis://...) so
+# invalidations reach all of them. Without it each process caches on its own
+if os.getenv('CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('CACHE_URL'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    }
+
+# REST list endpoints: cursor pages of API_PAGE_SIZE, clients may ask for up to API_MAX_PAGE_SIZE
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 50))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 200))
+# Seconds a user's room listing is cached; membership and room changes invalidate it sooner
+ROOM_LIST_CACHE_TTL = int(os.getenv('ROOM_LIST_CACHE_TTL', 300))
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -101,12 +233,59 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'ChatProj.wsgi.application'
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Threads available to sync code called from async consumers; daphne sizes its
+# default executor from the same ASGI_THREADS variable
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', min(32, (os.cpu_count() or 1) + 4)))
+
+# DB_ENGINE=postgresql switches to a pooled server database (psycopg 3 pool).
+# Connections are returned to the pool after every call, so CONN_MAX_AGE stays 0
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'chat'),
+            'USER': os.getenv('POSTGRES_USER', 'chat'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'postgres'),
+            'PORT': int(os.getenv('POSTGRES_PORT', 5432)),
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                    # One connection per executor thread, plus the single-thread
+                    # executors used for thread-sensitive calls and membership events
+                    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', ASGI_THREADS + 2)),
+                    'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+                },
+            },
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # WAL lets readers run alongside the single writer; IMMEDIATE takes
+                # the write lock up front instead of failing to upgrade a read lock
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA temp_store=MEMORY;'
+                    'PRAGMA cache_size=-20000;'
+                    'PRAGMA mmap_size=134217728;'
+                ),
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
+    }
+
+# Only a pooled database can serve consumers from many threads at once; SQLite
+# keeps every consumer query on one thread, where its write lock is uncontended
+DATABASE_THREAD_SENSITIVE = DB_ENGINE != 'postgresql'
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -1,11 +1,12 @@
 from django.contrib import admin
-from .models import ChatRoom, Message, UserChatActivity, ChatHistory, MessageQueue
+from .models import ChatRoom, Message, UserChatActivity, ChatHistory, MessageQueue, MessageSegment
 
 admin.site.register(ChatRoom)
 admin.site.register(Message)
 admin.site.register(UserChatActivity)
 admin.site.register(ChatHistory)
 admin.site.register(MessageQueue)
+admin.site.register(MessageSegment)
 
 
 
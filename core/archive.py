@@ -0,0 +1,113 @@
+"""
+Cold storage for old chat messages.
+
+Messages older than ``CHAT_ARCHIVE_AFTER_DAYS`` are moved out of ``Message``
+into ``MessageSegment`` rows: runs of up to ``CHAT_ARCHIVE_SEGMENT_SIZE``
+consecutive messages of one room, stored as compressed JSON. A room is always
+archived from its oldest message up to an id boundary, so every archived id is
+below every id left in ``Message``; history reads continue into the archive
+where the hot table ends (see ``core.timeline.fetch_page``).
+"""
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Message, MessageSegment
+
+
+def encode_rows(messages):
+    rows = [
+        [message.id, message.user_id, message.user.username, message.content, message.timestamp.isoformat()]
+        for message in messages
+    ]
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf8'))
+
+
+def decode_segment(segment):
+    """Messages of a segment in ``timeline.serialize_message`` form, oldest first."""
+    rows = json.loads(zlib.decompress(bytes(segment.data)))
+    return [
+        {'id': id, 'message': content, 'username': username, 'user_id': user_id, 'timestamp': timestamp}
+        for id, user_id, username, content, timestamp in rows
+    ]
+
+
+def archive_cutoff(days=None):
+    return timezone.now() - timedelta(days=settings.CHAT_ARCHIVE_AFTER_DAYS if days is None else days)
+
+
+def archive_room(room_id, cutoff, segment_size=None):
+    """Move a room's messages sent before ``cutoff`` into segments; return how many moved."""
+    segment_size = segment_size or settings.CHAT_ARCHIVE_SEGMENT_SIZE
+    # Everything up to the newest old message goes, keeping the hot table an id suffix
+    boundary = (
+        Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+        .order_by('-timestamp', '-id')
+        .values_list('id', flat=True)
+        .first()
+    )
+    if boundary is None:
+        return 0
+
+    moved = 0
+    while True:
+        with transaction.atomic():
+            messages = list(
+                Message.objects.filter(room_id=room_id, id__lte=boundary)
+                .select_related('user')
+                .only('id', 'content', 'timestamp', 'user_id', 'user__username')
+                .order_by('id')[:segment_size]
+            )
+            if not messages:
+                return moved
+            first, last = messages[0], messages[-1]
+            MessageSegment.objects.create(
+                room_id=room_id,
+                first_id=first.id,
+                last_id=last.id,
+                first_timestamp=first.timestamp,
+                last_timestamp=last.timestamp,
+                count=len(messages),
+                data=encode_rows(messages),
+            )
+            Message.objects.filter(room_id=room_id, id__gte=first.id, id__lte=last.id).delete()
+        moved += len(messages)
+
+
+def fetch_before(room_id, before, limit):
+    """The newest ``limit`` archived messages with ids below ``before``, oldest first."""
+    segments = MessageSegment.objects.filter(room_id=room_id).order_by('-first_id')
+    if before is not None:
+        segments = segments.filter(first_id__lt=before)
+    rows = []
+    # Segments are read newest first and only as far back as the page needs
+    for segment in segments.iterator(chunk_size=2):
+        rows[:0] = [row for row in decode_segment(segment) if before is None or row['id'] < before]
+        if len(rows) >= limit:
+            break
+    return rows[-limit:] if limit else []
+
+
+def fetch_after(room_id, after, limit):
+    """The oldest ``limit`` archived messages with ids above ``after``."""
+    rows = []
+    segments = MessageSegment.objects.filter(room_id=room_id, last_id__gt=after).order_by('last_id')
+    for segment in segments.iterator(chunk_size=2):
+        rows += [row for row in decode_segment(segment) if row['id'] > after]
+        if len(rows) >= limit:
+            break
+    return rows[:limit]
+
+
+def latest(room_id):
+    """``(id, timestamp)`` of the newest archived message of a room, or ``None``."""
+    return (
+        MessageSegment.objects.filter(room_id=room_id)
+        .order_by('-last_id')
+        .values_list('last_id', 'last_timestamp')
+        .first()
+    )
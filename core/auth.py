@@ -0,0 +1,125 @@
+"""
+JWT authentication for WebSocket handshakes.
+
+``JWTAuthMiddleware`` reads an access token from the ``token`` query parameter
+(browsers cannot set headers on a WebSocket) or an ``Authorization: Bearer``
+header, and checks its signature and expiry with simplejwt, which needs no
+database access. The token's user id is put in ``scope['token_user_id']``;
+an invalid token sets ``scope['token_error']`` instead.
+
+Consumers then resolve the user's room membership through ``membership_cache``,
+a small in-process LRU with a TTL, so a reconnect storm after a deploy hits the
+user and membership tables once per user and room rather than once per socket.
+
+Once connected, a client is also handed a signed session token. Presented with
+``?session=`` on a reconnect within ``CHAT_SESSION_MAX_AGE`` seconds, it lets
+the client receive only the messages it missed instead of a history page.
+"""
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.core import signing
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+class TTLCache:
+    """Least recently used mapping whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# (user_id, room_name) -> (room, user) for confirmed members only, so a user
+# added to a room can connect straight away. Removals discard entries in the
+# process that made them and in every worker with a socket in the room; other
+# workers notice within CHAT_AUTH_CACHE_TTL
+membership_cache = TTLCache(settings.CHAT_AUTH_CACHE_SIZE, settings.CHAT_AUTH_CACHE_TTL)
+
+
+SESSION_SALT = 'core.auth.session'
+
+
+def query_param(scope, name):
+    values = parse_qs(scope.get('query_string', b'').decode('latin1')).get(name)
+    return values[0] if values else None
+
+
+def session_token(user_id, room_name):
+    """Signed token that lets ``user_id`` resume a connection to ``room_name``."""
+    return signing.dumps([user_id, room_name], salt=SESSION_SALT, compress=True)
+
+
+def has_session(scope, user_id, room_name):
+    """
+    Whether the scope carries a valid, unexpired session token for this user
+    and room.
+
+    A session only lets a reconnect skip the history page; it grants no access,
+    membership is checked as for any other connection.
+    """
+    raw = query_param(scope, 'session')
+    if not raw:
+        return False
+    try:
+        token_user_id, token_room = signing.loads(raw, salt=SESSION_SALT, max_age=settings.CHAT_SESSION_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        return False
+    return token_user_id == user_id and token_room == room_name
+
+
+def _raw_token(scope):
+    token = query_param(scope, 'token')
+    if token:
+        return token
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            scheme, _, credentials = value.decode('latin1').partition(' ')
+            if scheme.lower() == 'bearer' and credentials:
+                return credentials.strip()
+    return None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        raw = _raw_token(scope)
+        if raw:
+            try:
+                token = AccessToken(raw)
+                scope['token_user_id'] = int(token[api_settings.USER_ID_CLAIM])
+            except (TokenError, KeyError, TypeError, ValueError) as e:
+                scope['token_error'] = str(e)
+        return await self.inner(scope, receive, send)
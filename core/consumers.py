@@ -1,220 +1,498 @@
-import json
-import os
-import redis
+import asyncio
+import collections
+import logging
+import random
+import time
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from .db import db_sync_to_async
 from django.core.exceptions import ObjectDoesNotExist
+from . import metrics, presence, protocol, ratelimit, timeline, workers
+from .auth import has_session, membership_cache, query_param, session_token
+from .writer import get_writer
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.redis_client = self.get_redis_client()
+logger = logging.getLogger(__name__)
 
+class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
         self.user_id = self.scope['url_route']['kwargs'].get('user_id')
+        self.last_seen_id = 0
+        # Newest id the client acknowledged, and ids sent since; None until its first ack
+        self.acked_id = None
+        self.unacked = collections.deque()
+        self.heartbeat_task = None
+        self.sender_task = None
+        self.drain_task = None
+        self.counted = False
+        # JSON by default, msgpack if the client offered it as a subprotocol
+        self.codec = protocol.negotiate(self.scope)
+
+        logger.debug("connecting room=%s user_id=%s", self.room_name, self.user_id)
+
+        # A worker being drained refuses new sockets; the client retries and
+        # lands on another process sharing the listening socket
+        if workers.draining:
+            await self.close()
+            return
 
-        print(f"Connecting: room_name={self.room_name}, user_id={self.user_id}")
+        # A token, when present, must be valid and name the user in the URL
+        if not self.token_matches():
+            metrics.CONNECTIONS.inc(outcome='unauthenticated')
+            await self.reject('Authentication failed. Log in again.')
+            return
+
+        # Resolve room, user and membership once; they are held for the life of the
+        # connection and invalidated by membership events from core.signals
+        self.room, self.user = await self.load_membership()
 
         # Check if the user is authorized to join the room
-        if not await self.is_user_in_room(self.user_id, self.room_name):
-            # Accept the connection before sending an error message
-            await self.accept()
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'You do not have permission to chat in this room. Contact admin.'
-            }))
-            # Close the WebSocket connection
-            await self.close()
+        if self.user is None:
+            metrics.CONNECTIONS.inc(outcome='rejected')
+            await self.reject('You do not have permission to chat in this room. Contact admin.')
             return
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(self.codec.subprotocol)
+        # A session token from an earlier connection only changes what is sent below
+        resumed = has_session(self.scope, self.user_id, self.room_name)
+        metrics.CONNECTIONS.inc(outcome='resumed' if resumed else 'accepted')
+        metrics.ACTIVE_CONNECTIONS.inc(room=self.room_name)
+        self.counted = True
+        if settings.CHAT_WORKER_ID:
+            await self.channel_layer.group_add(workers.worker_group(settings.CHAT_WORKER_ID), self.channel_name)
+            await workers.connection_opened()
 
         if self.user_id:
             # Mark user as connected in Redis
             await self.mark_user_connected(self.user_id)
 
-            # Send the user the chat history upon connection
-            room = await self.get_room(self.room_name)
-            chat_history = await self.get_chat_history(room, self.user_id)
-            await self.send(text_data=json.dumps({
-                'type': 'chat_history',
-                'history': chat_history
-            }))
-
-            # Deliver queued messages
-            await self.deliver_queued_messages(self.user_id)
-
+            if settings.CHAT_WRITE_BEHIND:
+                await self.wait_for_writes()
 
+            last_id = timeline.parse_message_id(query_param(self.scope, 'last_id'))
+            if resumed and last_id is not None:
+                await self.send_delta(last_id)
+            else:
+                await self.send_initial_view()
 
-    async def is_user_in_room(self, user_id, room_name):
-        room = await self.get_room(room_name)
-        if room:
-            return await database_sync_to_async(room.users.filter(id=user_id).exists)()
-        return False
+            await self.send_frame({
+                'type': 'session',
+                'token': session_token(self.user_id, self.room_name)
+            })
 
+    async def wait_for_writes(self):
+        # History is read from the table: let messages sent before this
+        # connect reach it first, or they would be skipped
+        try:
+            await get_writer().wait_flushed()
+        except Exception as e:
+            logger.warning("waiting for unflushed messages failed room=%s: %s", self.room_name, e)
+
+    async def send_delta(self, last_id):
+        # A resumed client already has everything up to last_id: only what it
+        # missed goes out, read with one range query
+        page = await self.get_history_page(self.room, None, last_id, settings.CHAT_CATCHUP_LIMIT)
+        metrics.CATCHUP_SIZE.observe(len(page['history']))
+        self.last_seen_id = last_id
+        await self.send_frame({
+            'type': 'chat_catchup',
+            **page
+        }, message_id=page['next_cursor'])
+
+    async def send_initial_view(self):
+        # Send the user the page of chat history up to their read cursor;
+        # older pages are requested with {"type": "history", "before": cursor}
+        chat_history, unread = await self.get_chat_history(self.room, self.user_id)
+        metrics.CATCHUP_SIZE.observe(len(unread['history']))
+        # The read cursor follows these frames out; disconnect() saves it
+        await self.send_frame({
+            'type': 'chat_history',
+            **chat_history
+        }, message_id=chat_history['next_cursor'])
+
+        # Everything posted since the cursor goes out as a single batch;
+        # further batches are requested with {"type": "history", "after": next_cursor}
+        if unread['history']:
+            await self.send_frame({
+                'type': 'chat_catchup',
+                **unread
+            }, message_id=unread['next_cursor'])
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        # From here on frames go out through a bounded queue drained by one task,
+        # so a client that reads slowly cannot make the worker buffer without limit
+        self.outbox = asyncio.Queue(settings.CHAT_SEND_QUEUE_SIZE)
+        self.closed = False
+        self.sender_task = asyncio.create_task(self.sender())
+
+    async def send(self, text_data=None, bytes_data=None, close=False, message_id=None):
+        if self.sender_task is None:
+            return await super().send(text_data, bytes_data, close)
+        if text_data is not None:
+            message = {'type': 'websocket.send', 'text': text_data}
+        elif bytes_data is not None:
+            message = {'type': 'websocket.send', 'bytes': bytes_data}
+        else:
+            raise ValueError("You must pass one of bytes_data or text_data")
+        await self.enqueue(message, message_id)
+        if close:
+            await self.close(close)
+
+    async def close(self, code=None, reason=None):
+        if self.sender_task is None:
+            return await super().close(code, reason)
+        # Queued behind the frames already waiting, so they still go out first
+        message = {'type': 'websocket.close'}
+        if code is not None and code is not True:
+            message['code'] = code
+        if reason:
+            message['reason'] = reason
+        await self.enqueue(message)
+        # Nothing may follow the close frame
+        self.closed = True
+
+    async def enqueue(self, message, message_id=None):
+        if self.closed:
+            return
+        # Daphne writes to the transport without limit, so the outbox rarely
+        # fills there; a client that acknowledges is measured by its acks instead
+        if self.acked_id is not None and len(self.unacked) >= settings.CHAT_MAX_UNACKED:
+            await self.drop_slow_client()
+            return
+        try:
+            self.outbox.put_nowait((message, message_id))
+        except asyncio.QueueFull:
+            await self.drop_slow_client()
+
+    async def sender(self):
+        while True:
+            message, message_id = await self.outbox.get()
+            await self.base_send(message)
+            # Counts as seen once handed to the server, not when it was queued
+            if message_id:
+                self.last_seen_id = max(self.last_seen_id, message_id)
+                if self.acked_id is not None:
+                    self.unacked.append(message_id)
+            if message['type'] == 'websocket.close':
+                return
+
+    async def drop_slow_client(self):
+        # Whatever is still queued is dropped with the connection; the read cursor
+        # only covers frames actually sent, so the client catches up on reconnect
+        logger.warning("dropping slow client room=%s user_id=%s", self.room_name, self.user_id)
+        metrics.SLOW_CLIENTS.inc()
+        self.closed = True
+        self.sender_task.cancel()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await super().close(protocol.CLOSE_TRY_AGAIN_LATER)
+
+    async def reject(self, message):
+        # Accept the connection before sending an error message
+        await self.accept(self.codec.subprotocol)
+        await self.send_frame({
+            'type': 'error',
+            'message': message
+        })
+        # Close the WebSocket connection
+        await self.close()
 
     async def disconnect(self, close_code):
         # Leave room group
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-        if self.user_id:
-            # Mark user as disconnected in Redis
+        if self.sender_task:
+            self.sender_task.cancel()
+        if self.drain_task:
+            self.drain_task.cancel()
+
+        metrics.DISCONNECTS.inc()
+        if self.counted:
+            metrics.ACTIVE_CONNECTIONS.dec(room=self.room_name)
+            if settings.CHAT_WORKER_ID:
+                await self.channel_layer.group_discard(
+                    workers.worker_group(settings.CHAT_WORKER_ID), self.channel_name,
+                )
+                await workers.connection_closed()
+
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            # Mark this connection as gone in Redis
             await self.mark_user_disconnected(self.user_id)
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+        # Persist how far this connection got, once, instead of per delivered message;
+        # a client that acknowledges has read no further than its last ack
+        read_id = self.last_seen_id
+        if self.acked_id is not None:
+            read_id = min(read_id, self.acked_id)
+        if getattr(self, 'user', None) and read_id:
+            await self.save_read_cursor(self.room, self.user_id, read_id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        size = len(bytes_data) if bytes_data is not None else len((text_data or '').encode('utf8'))
+        if size > settings.CHAT_MAX_FRAME_BYTES:
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Message too large.'
+            })
+            await self.close(protocol.CLOSE_TOO_LARGE)
+            return
+
+        try:
+            text_data_json = self.codec.decode(text_data, bytes_data)
+        except ValueError as e:
+            # Malformed JSON or msgpack, or a frame of the wrong shape
+            message = str(e) if isinstance(e, protocol.InvalidFrame) else 'Invalid frame.'
+            await self.send_frame({
+                'type': 'error',
+                'message': message
+            })
+            return
+        if text_data_json.get('type') == 'ack':
+            # Touches neither Redis nor the database, so not rate limited
+            self.acknowledge(text_data_json.get('id'))
+            return
+        if await self.rate_limited(text_data_json.get('type') not in ('history', 'presence')):
+            return
+
+        if text_data_json.get('type') == 'history':
+            await self.send_history_page(text_data_json)
+            return
+        if text_data_json.get('type') == 'presence':
+            await self.send_presence(text_data_json.get('users'))
+            return
+
+        received = time.perf_counter()
         message = text_data_json.get('message', '')
         timestamp = text_data_json.get('timestamp', '')
 
+        logger.debug("received message room=%s user_id=%s length=%d", self.room_name, self.user_id, len(message))
 
-        print(f"Received message: {message}, user_id={self.user_id}")
+        if self.user is None:
+            return
 
         try:
-            user = await self.get_user(self.user_id)
-            if user:
-                username = user.username
-            else:
-                username = 'Anonymous'
-                print(f"User not found for user_id={self.user_id}")
-
-            room = await self.get_room(self.room_name)
-            if room:
-                # Save the message to the database and update chat history
-                message_obj = await self.create_message(user, room, message)
-
-                # Check if user is connected and send the message to the room group
-                is_connected = await self.is_user_connected(self.user_id)
-
-                if not is_connected:
-                    # Queue the message for disconnected users
-                    await self.queue_message(user.id, room.id, message)
-                else:
-                    # Send the message to the room group
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message,
-                            'username': username,
-                            'timestamp': timestamp
-                        }
-                    )
-            else:
-                await self.send(text_data=json.dumps({'error': 'Room does not exist'}))
+            # Save the message to the database; members who are offline pick it
+            # up from the timeline after their read cursor when they reconnect
+            message_obj = await self.create_message(self.user, self.room, message)
+
+            # Send the message to the room group, encoded once for all recipients
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'chat_message',
+                    'id': message_obj.id,
+                    'payload': protocol.preencode({
+                        'type': 'chat_message',
+                        'id': message_obj.id,
+                        'message': message,
+                        'username': self.user.username,
+                        'timestamp': timestamp
+                    })
+                }
+            )
+            metrics.MESSAGES.inc()
+            metrics.BROADCAST_LATENCY.observe(time.perf_counter() - received)
         except ObjectDoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'Room does not exist'}))
-        except Exception as e:
-            print(f"Error receiving message: {e}")
+            await self.send_frame({'error': 'Room does not exist'})
+        except Exception:
+            logger.exception("error handling message room=%s user_id=%s", self.room_name, self.user_id)
 
-    async def chat_message(self, event):
-        print(f"Sending message: {event['message']}, username={event['username']}")
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'username': event['username'],
-            'timestamp': event['timestamp']
-
-        }))
-
-    async def user_joined(self, event):
-        print(f"User joined: {event['username']}")
-        await self.send(text_data=json.dumps({
-            'type': 'user_joined',
-            'username': event['username'],
-            'room': self.room_name  # Added room information
-        }))
-
-    async def user_left(self, event):
-        print(f"User left: {event['username']}")
-        await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'username': event['username'],
-            'room': self.room_name  # Added room information
-        }))
-
-    @database_sync_to_async
-    def get_room(self, room_name):
-        from .models import ChatRoom
-        try:
-            return ChatRoom.objects.get(name=room_name)
-        except ChatRoom.DoesNotExist:
-            return None
+    def acknowledge(self, message_id):
+        message_id = timeline.parse_message_id(message_id)
+        if message_id is None:
+            return
+        self.acked_id = max(self.acked_id or 0, message_id)
+        while self.unacked and self.unacked[0] <= self.acked_id:
+            self.unacked.popleft()
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        from django.contrib.auth.models import User
+    async def rate_limited(self, is_message):
+        if self.user is None:
+            return False
         try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
+            retry_after = await ratelimit.check_frame(self.user_id, self.room_name, is_message)
+        except Exception as e:
+            # Fail open: a Redis outage should not silence every room
+            logger.warning("rate limit check failed user_id=%s: %s", self.user_id, e)
+            return False
+        if retry_after:
+            metrics.RATE_LIMITED.inc()
+            await self.send_frame({
+                'type': 'rate_limited',
+                'retry_after': round(retry_after, 2)
+            })
+        return bool(retry_after)
 
-    @database_sync_to_async
-    def create_message(self, user, room, content):
-        from .models import Message, ChatHistory
-        if user and room:
-            message = Message.objects.create(user=user, room=room, content=content)
-            
-            # Get or create chat history entry for the user
-            chat_history, created = ChatHistory.objects.get_or_create(chat_room=room, user_id=user.id)
-            
-            # Load existing history or initialize as empty list
-            history = json.loads(chat_history.history) if chat_history.history else []
-            
-            # Append the new message
-            history.append({
-                'message': message.content,
-                'username': user.username,
-                'timestamp': message.timestamp.isoformat()
+    async def send_frame(self, frame, message_id=None):
+        # message_id: newest message in the frame, counted as seen once it is sent
+        await self.send(message_id=message_id, **self.codec.encode(frame))
+
+    async def send_history_page(self, request):
+        if self.user is None:
+            return
+        limit = timeline.clamp_limit(request.get('limit'))
+        if request.get('after') is not None:
+            # Forward paging continues a catch-up batch
+            page = await self.get_history_page(self.room, None, request.get('after'), limit)
+            frame_type = 'chat_catchup'
+            message_id = page['next_cursor']
+        else:
+            page = await self.get_history_page(self.room, request.get('before'), None, limit)
+            frame_type = 'chat_history_page'
+            message_id = None
+        await self.send_frame({
+            'type': frame_type,
+            **page
+        }, message_id=message_id)
+
+    async def send_presence(self, users=None):
+        if self.user is None:
+            return
+        frame = {'type': 'presence'}
+        try:
+            frame['online'] = await presence.online_in_room(self.room_name)
+            if isinstance(users, list):
+                # Connected anywhere, not just in this room: any tab on any worker counts
+                user_ids = {
+                    user_id for user_id in users[:settings.PRESENCE_MAX_USERS]
+                    if isinstance(user_id, int) and not isinstance(user_id, bool)
+                }
+                frame['connected'] = await presence.connected_users(user_ids)
+        except Exception as e:
+            logger.warning("presence lookup failed room=%s: %s", self.room_name, e)
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Presence is unavailable.'
             })
-            chat_history.history = json.dumps(history)
-            chat_history.save()
+            return
+        await self.send_frame(frame)
 
-            return message
+    async def chat_message(self, event):
+        await self.send(message_id=event.get('id'), **self.codec.encoded(event['payload']))
+
+    async def members_joined(self, event):
+        await self.send(**self.codec.encoded(event['payload']))
+
+    async def members_left(self, event):
+        for user in event['users']:
+            membership_cache.discard((user['id'], self.room_name))
+        await self.send(**self.codec.encoded(event['payload']))
+        if any(user['id'] == self.user_id for user in event['users']):
+            await self.revoke_membership()
+
+    async def membership_reset(self, event):
+        # The room's member list was cleared or rebuilt; re-check ours once
+        membership_cache.discard((self.user_id, self.room_name))
+        self.room, self.user = await self.load_membership()
+        if self.user is None:
+            await self.revoke_membership()
+
+    async def server_drain(self, event):
+        # Sent by runworkers before it stops this process. Sockets close at random
+        # points over the window rather than all at once, so their reconnects
+        # (to other workers) do not arrive as one burst
+        workers.draining = True
+        if self.drain_task is None:
+            delay = random.uniform(0, event.get('window', settings.CHAT_DRAIN_WINDOW))
+            self.drain_task = asyncio.create_task(self.drain_after(delay))
+
+    async def drain_after(self, delay):
+        await asyncio.sleep(delay)
+        # The session token and last received id let the client resume with just the delta
+        await self.send_frame({
+            'type': 'reconnect',
+            'retry_after': round(random.uniform(0, settings.CHAT_RECONNECT_JITTER), 2)
+        })
+        await self.close(protocol.CLOSE_SERVICE_RESTART)
+
+    async def revoke_membership(self):
+        self.user = None
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.send_frame({
+            'type': 'error',
+            'message': 'You have been removed from this room.'
+        })
+        await self.close()
+
+    def token_matches(self):
+        if self.scope.get('token_error'):
+            return False
+        token_user_id = self.scope.get('token_user_id')
+        if token_user_id is None:
+            return not settings.CHAT_WS_REQUIRE_TOKEN
+        return token_user_id == self.user_id
+
+    async def load_membership(self):
+        key = (self.user_id, self.room_name)
+        cached = membership_cache.get(key)
+        if cached is not None:
+            return cached
+        room, user = await self.get_membership(self.user_id, self.room_name)
+        if user is not None:
+            membership_cache.set(key, (room, user))
+        return room, user
+
+    @db_sync_to_async
+    def get_membership(self, user_id, room_name):
+        from django.contrib.auth.models import User
+        from .models import ChatRoom
+        room = ChatRoom.objects.filter(name=room_name).first()
+        if room is None:
+            return None, None
+        return room, User.objects.filter(id=user_id, chat_rooms=room).first()
+
+    async def create_message(self, user, room, content):
+        if settings.CHAT_WRITE_BEHIND:
+            # Id assigned now, row written by the background writer's next flush
+            return await get_writer().submit(user, room, content)
+        return await self.save_message(user, room, content)
+
+    @db_sync_to_async
+    def save_message(self, user, room, content):
+        if user and room:
+            return timeline.append_message(user, room, content)
         return None
 
-    @database_sync_to_async
+    @db_sync_to_async
     def get_chat_history(self, room, user_id):
-        from .models import ChatHistory
-        if room:
-            try:
-                chat_history, created = ChatHistory.objects.get_or_create(chat_room=room, user_id=user_id)
-                history = json.loads(chat_history.history) if isinstance(chat_history.history, str) else chat_history.history
-                return history
-            except ChatHistory.DoesNotExist:
-                return []
-        return []
-
-    def get_redis_client(self):
-        return redis.Redis(
-            host=os.getenv('CHANNEL_LAYERS_HOST', 'redis'),
-            port=int(os.getenv('CHANNEL_LAYERS_PORT', 6379))
+        return timeline.user_view(room.id, user_id)
+
+    @db_sync_to_async
+    def get_history_page(self, room, before, after, limit):
+        return timeline.history_page(
+            room.id,
+            before=timeline.parse_message_id(before),
+            after=timeline.parse_message_id(after),
+            limit=limit,
         )
 
+    @db_sync_to_async
+    def save_read_cursor(self, room, user_id, message_id):
+        timeline.mark_read(user_id, room.id, message_id)
+
     async def mark_user_connected(self, user_id):
-        self.redis_client.set(f'user:{user_id}:connected', 1)
+        try:
+            await presence.touch(user_id, self.room_name, self.channel_name)
+        except Exception as e:
+            # Fail open like the rate limits; the heartbeat retries the lease
+            logger.warning("presence registration failed user_id=%s: %s", user_id, e)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat(user_id))
+
+    async def heartbeat(self, user_id):
+        # Renew this connection's presence lease until the socket closes
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            try:
+                await presence.touch(user_id, self.room_name, self.channel_name)
+            except Exception as e:
+                logger.warning("presence renewal failed user_id=%s: %s", user_id, e)
 
     async def mark_user_disconnected(self, user_id):
-        self.redis_client.delete(f'user:{user_id}:connected')
-
-    async def is_user_connected(self, user_id):
-        return self.redis_client.exists(f'user:{user_id}:connected')
-
-    async def queue_message(self, user_id, room_id, message):
-        self.redis_client.rpush(f'user:{user_id}:queue', json.dumps({'room_id': room_id, 'message': message}))
-
-    async def deliver_queued_messages(self, user_id):
-        while self.redis_client.llen(f'user:{user_id}:queue') > 0:
-            message_data = json.loads(self.redis_client.lpop(f'user:{user_id}:queue'))
-            room = await self.get_room(self.room_name)
-            user = await self.get_user(user_id)
-            if user and room:
-                await self.create_message(user, room, message_data['message'])
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_message',
-                    'message': message_data['message'],
-                    'username': user.username
-                }))
+        try:
+            await presence.leave(user_id, self.room_name, self.channel_name)
+        except Exception as e:
+            # The lease runs out on its own within PRESENCE_TTL
+            logger.warning("presence removal failed user_id=%s: %s", user_id, e)
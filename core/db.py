@@ -0,0 +1,24 @@
+import functools
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .metrics import DB_CALL
+
+
+def db_sync_to_async(func):
+    """
+    ``database_sync_to_async`` that runs on the executor's thread pool when the
+    database is pooled, instead of queueing every call behind one thread.
+    Time spent in ``func`` is recorded per function name.
+    """
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_CALL.observe(time.perf_counter() - started, method=func.__name__)
+
+    return database_sync_to_async(timed, thread_sensitive=settings.DATABASE_THREAD_SENSITIVE)
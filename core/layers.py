@@ -0,0 +1,241 @@
+"""
+Channel layers backed by several Redis instances.
+
+``channels_redis`` already spreads keys over multiple hosts, but it picks the
+host with ``crc32(key) % len(hosts)``, so adding a host moves almost every
+group to a different node. ``ShardedRedisChannelLayer`` places keys on a
+consistent hash ring instead:
+
+- each ``chat_{room}`` group, with its membership set, lives on exactly one
+  node, so a room's group operations touch a single Redis;
+- nodes are identified by their address rather than their position in the
+  ``hosts`` list, so every worker computes the same ring and adding or
+  removing a node only moves the keys that belonged to it (about ``1/N``).
+
+``LocalFanoutChannelLayer`` adds an in-process tier on top: group members
+living in the same worker are delivered to directly, and the Redis group only
+holds one entry per worker, so a ``group_send`` writes one message per remote
+worker instead of going through Redis for every recipient.
+"""
+import asyncio
+import bisect
+import collections
+import hashlib
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'big')
+
+
+def host_identity(host):
+    """Stable name of a decoded ``channels_redis`` host entry."""
+    if 'address' in host:
+        return str(host['address'])
+    if 'master_name' in host:
+        return f"sentinel:{host['master_name']}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}/{host.get('db', 0)}"
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=160):
+        # Each node is placed at ``replicas`` points to even out the key spread
+        points = sorted(
+            (_hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def get(self, key):
+        """Index of the node owning ``key``."""
+        position = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._indexes[position]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, ring_replicas=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing([host_identity(host) for host in self.hosts], ring_replicas)
+
+    def consistent_hash(self, value):
+        # Used by channels_redis for groups and for channel names alike
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        # send() hashes the full name of a process-specific channel while
+        # receive_single() hashes only its "specific.<prefix>!" part; hash the
+        # shared part so both land on the node the process is listening on
+        if '!' in value:
+            value = self.non_local_name(value)
+        return self.ring.get(value)
+
+
+# Same script channels_redis uses for group_send: push to every key that is
+# under capacity and report how many were full
+GROUP_SEND_LUA = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i=1,#KEYS do
+    if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+        redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+class LocalFanoutChannelLayer(ShardedRedisChannelLayer):
+    """
+    Each worker registers a single ``specific.<worker>!group.<group>`` channel
+    in a Redis group, however many of its sockets joined. Messages arriving on
+    that channel are expanded to the worker's local members on receipt. Plain
+    ``RedisChannelLayer`` processes can share the same groups: they simply send
+    to the worker channel like to any other member.
+    """
+
+    fanout_prefix = 'group.'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # group -> channels of this process in that group
+        self.local_groups = collections.defaultdict(set)
+        # fanout channel digest -> group, to expand worker channels on receipt
+        self.fanout_groups = {}
+        # Loop the consumers receive on; receive buffers are only safe to fill from it
+        self.local_loop = None
+        # Set on local delivery so a receiver blocked on Redis looks at its buffer
+        self.local_wakeup = None
+        # Redis pops outlive the receive_single call they were started by, so
+        # waking up for a local delivery never cancels one mid-flight
+        self.pending_pops = {}
+
+    def _bind_local_loop(self):
+        # Channels starts receiving before connect() joins any group, so both
+        # group_add and receive_single bind the loop
+        if self.local_loop is not asyncio.get_running_loop():
+            self.local_loop = asyncio.get_running_loop()
+            self.local_wakeup = asyncio.Event()
+            self.pending_pops = {}
+
+    def fanout_channel(self, group):
+        # Group names may be up to 100 characters, as may channel names; a
+        # fixed-length digest keeps the worker channel under the limit
+        return f'specific.{self.client_prefix}!{self.fanout_prefix}{self.group_digest(group)}'
+
+    @staticmethod
+    def group_digest(group):
+        return hashlib.md5(group.encode('utf8')).hexdigest()
+
+    def is_local(self, channel):
+        return '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    async def group_add(self, group, channel):
+        if not self.is_local(channel):
+            return await super().group_add(group, channel)
+        self._bind_local_loop()
+        self.local_groups[group].add(channel)
+        self.fanout_groups[self.group_digest(group)] = group
+        # Also refreshes the entry's timestamp against group_expiry
+        await super().group_add(group, self.fanout_channel(group))
+
+    async def group_discard(self, group, channel):
+        if not self.is_local(channel):
+            return await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.local_groups[group]
+            self.fanout_groups.pop(self.group_digest(group), None)
+            await super().group_discard(group, self.fanout_channel(group))
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        own_channel = None
+        # From another loop (e.g. a background thread) the local buffers are off
+        # limits; our own worker channel is then reached through Redis like any other
+        if asyncio.get_running_loop() is self.local_loop:
+            own_channel = self.fanout_channel(group)
+            for channel in self.local_groups.get(group, ()):
+                self.receive_buffer[channel].put_nowait(dict(message))
+            if self.local_groups.get(group):
+                self.local_wakeup.set()
+
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        await connection.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+        channel_names = [
+            name for name in (x.decode('utf8') for x in await connection.zrange(key, 0, -1))
+            if name != own_channel
+        ]
+        if channel_names:
+            await self._send_to_channels(channel_names, message)
+
+    async def _send_to_channels(self, channel_names, message):
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            connection = self.connection(connection_index)
+            args = [channel_keys_to_message[key] for key in channel_redis_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_redis_keys]
+            args += [time.time(), self.expiry]
+            await connection.eval(GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args)
+
+    async def receive_single(self, channel):
+        if '!' not in channel:
+            return await self._receive_remote(channel)
+        self._bind_local_loop()
+
+        pop = self.pending_pops.get(channel)
+        if pop is None:
+            pop = self.pending_pops[channel] = asyncio.ensure_future(self._receive_remote(channel))
+        wakeup = asyncio.ensure_future(self.local_wakeup.wait())
+        try:
+            await asyncio.wait([pop, wakeup], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wakeup.cancel()
+        if not pop.done():
+            # A local delivery landed in the buffers; an empty result makes
+            # receive() check them again while the Redis pop keeps running
+            self.local_wakeup.clear()
+            return [], None
+        del self.pending_pops[channel]
+        return pop.result()
+
+    async def _receive_remote(self, channel):
+        message_channel, message = await super().receive_single(channel)
+        names = message_channel if isinstance(message_channel, list) else [message_channel]
+        if not any(self.fanout_prefix in name for name in names):
+            return message_channel, message
+        # Expand worker channels into the local members of their group
+        channels = []
+        for name in names:
+            local_name = name[name.find('!') + 1:]
+            if '!' in name and local_name.startswith(self.fanout_prefix):
+                group = self.fanout_groups.get(local_name[len(self.fanout_prefix):])
+                channels.extend(self.local_groups.get(group, ()))
+            else:
+                channels.append(name)
+        return channels, message
+
+    async def flush(self):
+        self.local_groups.clear()
+        self.fanout_groups.clear()
+        for pop in self.pending_pops.values():
+            pop.cancel()
+        self.pending_pops.clear()
+        await super().flush()
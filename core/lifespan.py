@@ -0,0 +1,21 @@
+"""
+ASGI lifespan handler.
+
+Servers that speak the lifespan protocol (uvicorn, hypercorn) call this on
+startup and shutdown; it is where process-wide state is flushed before the
+worker exits. Daphne never calls it: under Daphne the writer flushes from a
+reactor shutdown trigger instead (see ``core/writer.py``).
+"""
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            from .writer import get_writer
+            # Persist anything still buffered by the write-behind writer
+            await get_writer().close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import archive
+from core.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = "Move messages older than CHAT_ARCHIVE_AFTER_DAYS into compressed per-room segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--room', help='Only archive this room')
+        parser.add_argument('--segment-size', type=int, default=settings.CHAT_ARCHIVE_SEGMENT_SIZE)
+
+    def handle(self, *args, **options):
+        cutoff = archive.archive_cutoff(options['days'])
+        rooms = ChatRoom.objects.order_by('id')
+        if options['room']:
+            rooms = rooms.filter(name=options['room'])
+
+        total = 0
+        for room_id, name in rooms.values_list('id', 'name'):
+            moved = archive.archive_room(room_id, cutoff, options['segment_size'])
+            if moved:
+                self.stdout.write(f'{name}: archived {moved} messages')
+            total += moved
+        self.stdout.write(f'Archived {total} messages sent before {cutoff:%Y-%m-%d %H:%M}')
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import platform
+import subprocess
+import time
+from contextlib import ExitStack
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from core.bench import percentile, rss_bytes
+from core.models import ChatRoom
+
+# Rate limits would otherwise refuse most of the benchmark's traffic
+UNLIMITED = {
+    'CHAT_RATE_USER': 1e9,
+    'CHAT_RATE_USER_BURST': 10 ** 9,
+    'CHAT_RATE_ROOM': 1e9,
+    'CHAT_RATE_ROOM_BURST': 10 ** 9,
+}
+
+
+class Client:
+    """One simulated browser tab connected to ws/chat/<room>/<user_id>/."""
+
+    def __init__(self, application, room_name, user_id):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, f'/ws/chat/{room_name}/{user_id}/')
+        self.latencies = []
+
+    async def connect(self):
+        started = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise CommandError('A benchmark client was refused')
+        # Connected for our purposes once the initial history has arrived
+        await self.next_output(30)
+        return time.perf_counter() - started
+
+    async def next_output(self, timeout):
+        # Not receive_output(): on timeout it cancels the consumer, and every
+        # later call on the communicator raises CancelledError
+        return await asyncio.wait_for(self.communicator.output_queue.get(), timeout)
+
+    async def send(self, sequence):
+        # The timestamp field is passed through to every recipient untouched
+        await self.communicator.send_to(text_data=json.dumps({
+            'message': f'bench {sequence}',
+            'timestamp': repr(time.time()),
+        }))
+
+    async def read(self, expected, timeout):
+        deadline = time.perf_counter() + timeout
+        while len(self.latencies) < expected:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            try:
+                output = await self.next_output(remaining)
+            except asyncio.TimeoutError:
+                return
+            if output['type'] != 'websocket.send':
+                return
+            frame = json.loads(output['text'])
+            if frame.get('type') == 'chat_message':
+                self.latencies.append(time.time() - float(frame['timestamp']))
+
+    async def close(self):
+        # A consumer that already finished (it closed the socket) has nothing to disconnect
+        if self.communicator.future.done():
+            return
+        await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive simulated WebSocket clients through ChatConsumer and report connect latency, "
+        "delivery latency, throughput and memory per room size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000', help='Comma separated room sizes, one round each')
+        parser.add_argument('--messages', type=int, default=100, help='Messages sent per round')
+        parser.add_argument('--senders', type=int, default=10, help='Clients that send, round robin')
+        parser.add_argument('--interval', type=float, default=0.01, help='Seconds between sends')
+        parser.add_argument(
+            '--layer', choices=['memory', 'redis'], default='memory',
+            help='In-memory channel layer, or the one configured in CHANNEL_LAYERS',
+        )
+        parser.add_argument('--connect-batch', type=int, default=100, help='Clients connecting at once')
+        parser.add_argument('--timeout', type=float, default=60)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Earlier results to compare against')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='Allowed relative regression against --baseline before exiting non-zero',
+        )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        overrides = dict(UNLIMITED)
+        if options['layer'] == 'memory':
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}},
+            }
+
+        users = self.create_users(max(sizes))
+        rooms = [self.create_room(size, users[:size]) for size in sizes]
+        try:
+            with override_settings(**overrides), ExitStack() as stubs:
+                if options['layer'] == 'memory':
+                    # No Redis in this mode: presence and rate limits become no-ops
+                    for target in ('core.presence.touch', 'core.presence.leave', 'core.ratelimit.check_frame'):
+                        stubs.enter_context(mock.patch(target, mock.AsyncMock(return_value=0)))
+                from ChatProj.asgi import application
+                # One event loop for every round, as in a real worker
+                rounds = asyncio.run(self.run_rounds(application, rooms, sizes, users, options))
+        finally:
+            ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        results = {'meta': self.meta(options), 'rounds': rounds}
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def create_users(self, count):
+        names = [f'benchchat_{i}' for i in range(count)]
+        User.objects.bulk_create([User(username=name) for name in names], ignore_conflicts=True)
+        users = {user.username: user for user in User.objects.filter(username__in=names)}
+        return [users[name] for name in names]
+
+    def create_room(self, size, users):
+        room = ChatRoom.objects.create(name=f'benchchat_{size}_{int(time.time())}')
+        # Through rows directly: the benchmark should not broadcast membership events
+        ChatRoom.users.through.objects.bulk_create(
+            [ChatRoom.users.through(chatroom_id=room.id, user_id=user.id) for user in users]
+        )
+        return room
+
+    async def run_rounds(self, application, rooms, sizes, users, options):
+        rounds = []
+        for room, size in zip(rooms, sizes):
+            result = await self.run_round(application, room.name, users[:size], options)
+            self.report(result)
+            rounds.append(result)
+        return rounds
+
+    async def run_round(self, application, room_name, users, options):
+        rss_before = rss_bytes()
+        clients = [Client(application, room_name, user.id) for user in users]
+
+        connect_latencies = []
+        batch = options['connect_batch']
+        for start in range(0, len(clients), batch):
+            connect_latencies += await asyncio.gather(*(client.connect() for client in clients[start:start + batch]))
+        rss_connected = rss_bytes()
+
+        messages = options['messages']
+        senders = clients[:max(1, min(options['senders'], len(clients)))]
+        readers = [asyncio.create_task(client.read(messages, options['timeout'])) for client in clients]
+        started = time.perf_counter()
+        for sequence in range(messages):
+            await senders[sequence % len(senders)].send(sequence)
+            await asyncio.sleep(options['interval'])
+        await asyncio.gather(*readers)
+        elapsed = time.perf_counter() - started
+
+        for client in clients:
+            await client.close()
+
+        latencies = [latency for client in clients for latency in client.latencies]
+        expected = messages * len(clients)
+        return {
+            'room_size': len(clients),
+            'messages': messages,
+            'deliveries': len(latencies),
+            'lost': expected - len(latencies),
+            'connect_p50_ms': percentile(connect_latencies, 0.5) * 1000,
+            'connect_p99_ms': percentile(connect_latencies, 0.99) * 1000,
+            'delivery_p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'delivery_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'sent_per_sec': messages / elapsed,
+            'delivered_per_sec': len(latencies) / elapsed,
+            'rss_mb': rss_bytes() / 2 ** 20,
+            'rss_per_client_kb': (rss_connected - rss_before) / len(clients) / 1024,
+        }
+
+    def report(self, result):
+        self.stdout.write(
+            f"room_size={result['room_size']:<6} "
+            f"connect p50={result['connect_p50_ms']:.1f}ms p99={result['connect_p99_ms']:.1f}ms  "
+            f"delivery p50={result['delivery_p50_ms'] or 0:.1f}ms p99={result['delivery_p99_ms'] or 0:.1f}ms  "
+            f"{result['delivered_per_sec']:.0f} deliveries/s  lost={result['lost']}  "
+            f"rss={result['rss_mb']:.0f}MB ({result['rss_per_client_kb']:.0f}KB/client)"
+        )
+
+    def meta(self, options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR,
+            ).stdout.strip() or None
+        except OSError:
+            commit = None
+        return {
+            'date': timezone.now().isoformat(),
+            'commit': commit,
+            'layer': options['layer'],
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'options': {key: options[key] for key in ('sizes', 'messages', 'senders', 'interval')},
+        }
+
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as baseline_file:
+            baseline = {r['room_size']: r for r in json.load(baseline_file)['rounds']}
+        regressions = []
+        # Lower is better for latencies and memory, higher for throughput
+        checks = [('delivery_p99_ms', 1), ('connect_p99_ms', 1), ('rss_per_client_kb', 1), ('delivered_per_sec', -1)]
+        for result in results['rounds']:
+            old = baseline.get(result['room_size'])
+            if old is None:
+                continue
+            for key, direction in checks:
+                if not old.get(key) or result.get(key) is None:
+                    continue
+                change = (result[key] - old[key]) / old[key]
+                self.stdout.write(f"room_size={result['room_size']:<6} {key:<18} {change:+.1%}")
+                if change * direction > tolerance:
+                    regressions.append(f"{key} at room size {result['room_size']} ({change:+.1%})")
+        if regressions:
+            raise CommandError('Regressions: ' + ', '.join(regressions))
@@ -0,0 +1,69 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from core import timeline
+from core.bench import percentile
+from core.models import ChatRoom, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure message insert throughput with concurrent writer threads, the way "
+        "consumers write through database_sync_to_async."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--writers', default=f'1,4,{settings.ASGI_THREADS}',
+            help='Comma separated numbers of concurrent writers to run, one round each',
+        )
+        parser.add_argument('--messages', type=int, default=200, help='Messages per writer')
+        parser.add_argument('--room', default='benchdb')
+        parser.add_argument('--keep', action='store_true', help='Keep the inserted messages')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username='benchdb')
+        room, _ = ChatRoom.objects.get_or_create(name=options['room'])
+        start_id = Message.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+        self.stdout.write(f"database: {connection.vendor}, messages per writer: {options['messages']}")
+        try:
+            for writers in [int(n) for n in options['writers'].split(',')]:
+                self.run_round(writers, options['messages'], user, room)
+        finally:
+            if not options['keep']:
+                Message.objects.filter(room=room, user=user, id__gt=start_id).delete()
+
+    def run_round(self, writers, messages, user, room):
+        def write(worker):
+            latencies = []
+            try:
+                for i in range(messages):
+                    started = time.perf_counter()
+                    timeline.append_message(user, room, f'bench {worker}.{i}')
+                    latencies.append(time.perf_counter() - started)
+            finally:
+                # Hand this thread's connection back (to the pool, on Postgres)
+                connections.close_all()
+            return latencies
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=writers) as executor:
+            latencies = [
+                latency
+                for worker_latencies in executor.map(write, range(writers))
+                for latency in worker_latencies
+            ]
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"writers={writers:<3} inserts={len(latencies):<6} "
+            f"{len(latencies) / elapsed:9.1f} msg/s  "
+            f"p50={percentile(latencies, 0.5) * 1000:.2f}ms  "
+            f"p99={percentile(latencies, 0.99) * 1000:.2f}ms"
+        )
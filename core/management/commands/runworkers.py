@@ -0,0 +1,181 @@
+import itertools
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import workers
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve ChatProj.asgi with several Daphne processes sharing one listening socket. "
+        "SIGHUP restarts them one at a time, draining each first; SIGTERM/SIGINT drains all and exits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--backlog', type=int, default=2048)
+        parser.add_argument(
+            '--drain-timeout', type=float, default=30,
+            help='Seconds to wait for a worker\'s connections to leave before stopping it',
+        )
+        parser.add_argument(
+            '--drain-window', type=float, default=settings.CHAT_DRAIN_WINDOW,
+            help='Seconds over which a drained worker spreads the closing of its sockets',
+        )
+        parser.add_argument(
+            '--warmup', type=float, default=2,
+            help='Seconds a replacement worker gets to start before the old one is drained',
+        )
+        parser.add_argument('--status-interval', type=float, default=60, help='Seconds between connection reports')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.ids = itertools.count(1)
+        self.redis = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+        self.reload = False
+        self.stopping = False
+
+        # One socket for all workers: the kernel hands each accept() to whichever
+        # worker is free, and a replacement can start while the old one drains
+        self.socket = socket.create_server((options['bind'], options['port']), backlog=options['backlog'])
+        self.socket.set_inheritable(True)
+
+        signal.signal(signal.SIGHUP, self.on_reload)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+
+        # slot -> (worker id, process)
+        self.workers = {slot: self.spawn(slot) for slot in range(options['workers'])}
+        logger.info(
+            "serving on %s:%s with %d workers", options['bind'], options['port'], options['workers'],
+        )
+        next_status = time.monotonic() + options['status_interval']
+        while not self.stopping:
+            time.sleep(0.5)
+            if self.reload:
+                self.reload = False
+                self.rolling_restart()
+            self.replace_exited()
+            if time.monotonic() >= next_status:
+                next_status = time.monotonic() + options['status_interval']
+                self.report()
+
+        logger.info("draining all workers")
+        self.drain(list(self.workers.values()))
+        self.socket.close()
+
+    def on_reload(self, signum, frame):
+        self.reload = True
+
+    def on_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self, slot):
+        worker_id = f'{slot}-{next(self.ids)}'
+        process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'daphne',
+                '--fd', str(self.socket.fileno()),
+                'ChatProj.asgi:application',
+            ],
+            env={**os.environ, 'CHAT_WORKER_ID': worker_id},
+            pass_fds=(self.socket.fileno(),),
+            # Ctrl-C reaches only this process, which then drains the workers
+            start_new_session=True,
+        )
+        self.forget(worker_id)
+        logger.info("started worker=%s pid=%s", worker_id, process.pid)
+        return worker_id, process
+
+    def rolling_restart(self):
+        logger.info("rolling restart of %d workers", len(self.workers))
+        for slot, old in list(self.workers.items()):
+            if self.stopping:
+                return
+            # Start the replacement first so there is never one worker fewer accepting
+            self.workers[slot] = self.spawn(slot)
+            time.sleep(self.options['warmup'])
+            self.drain([old])
+
+    def replace_exited(self):
+        for slot, (worker_id, process) in list(self.workers.items()):
+            if process.poll() is not None:
+                logger.warning("worker=%s exited with code %s; replacing it", worker_id, process.returncode)
+                self.forget(worker_id)
+                self.workers[slot] = self.spawn(slot)
+
+    def drain(self, targets):
+        channel_layer = get_channel_layer()
+        for worker_id, process in targets:
+            try:
+                async_to_sync(channel_layer.group_send)(
+                    workers.worker_group(worker_id),
+                    {'type': 'server_drain', 'window': self.options['drain_window']},
+                )
+            except Exception as e:
+                logger.warning("drain request to worker=%s failed: %s", worker_id, e)
+
+        deadline = time.monotonic() + self.options['drain_timeout']
+        pending = list(targets)
+        while pending and time.monotonic() < deadline:
+            counts = self.counts()
+            pending = [
+                (worker_id, process) for worker_id, process in pending
+                if process.poll() is None and (counts is None or counts.get(worker_id, 0) > 0)
+            ]
+            if pending:
+                time.sleep(0.5)
+        if pending:
+            logger.warning(
+                "drain timed out with %d connections left",
+                sum((self.counts() or {}).get(worker_id, 0) for worker_id, _ in pending),
+            )
+
+        for worker_id, process in targets:
+            if process.poll() is None:
+                process.terminate()
+        for worker_id, process in targets:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            self.forget(worker_id)
+            logger.info("stopped worker=%s", worker_id)
+
+    def counts(self):
+        try:
+            return workers.connection_counts(self.redis)
+        except redis.RedisError as e:
+            # None: unknown, which keeps a drain waiting until its timeout
+            logger.warning("reading worker connection counts failed: %s", e)
+            return None
+
+    def forget(self, worker_id):
+        try:
+            self.redis.hdel(workers.CONNECTIONS_KEY, worker_id)
+        except redis.RedisError as e:
+            logger.warning("clearing the connection count of worker=%s failed: %s", worker_id, e)
+
+    def report(self):
+        counts = self.counts()
+        if counts is not None:
+            logger.info(
+                "connections %s",
+                ' '.join(f'{worker_id}={counts.get(worker_id, 0)}' for worker_id, _ in self.workers.values()),
+            )
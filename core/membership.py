@@ -0,0 +1,164 @@
+"""
+Room membership change notifications.
+
+Changes are coalesced into ``members_joined``/``members_left`` events that
+carry up to ``MEMBERSHIP_EVENT_BATCH_SIZE`` users each. They are handed to a
+single background thread once the surrounding transaction commits, so the
+admin or API request that changed membership never waits on the channel
+layer, and events for a room go out in the order they were made.
+
+``add_members``/``remove_members`` change many memberships at once with set
+based SQL on the through table; they bypass ``m2m_changed`` and announce the
+whole change themselves.
+
+Cached room listings are keyed by ``room_list_version()``; every membership or
+room change bumps it, which retires all cached listings at once.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .auth import membership_cache
+from .protocol import preencode
+
+logger = logging.getLogger(__name__)
+
+ROOM_LIST_VERSION_KEY = 'chat:rooms:version'
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='membership')
+
+
+def notify_members_changed(room_name, event_type, users):
+    """
+    Announce that ``users`` (``(id, username)`` pairs) joined or left a room.
+
+    ``event_type`` is ``'members_joined'`` or ``'members_left'``.
+    """
+    users = [{'id': user_id, 'username': username} for user_id, username in users]
+    if event_type == 'members_left':
+        # Forget confirmed memberships in this process straight away
+        for user in users:
+            membership_cache.discard((user['id'], room_name))
+    if users:
+        _after_commit(room_name, event_type, {'users': users})
+
+
+def notify_membership_reset(room_name):
+    """Ask connected members of a room to re-check their membership."""
+    # The cache cannot be searched by room; membership resets are rare
+    membership_cache.clear()
+    _after_commit(room_name, 'membership_reset', {})
+
+
+def room_list_version():
+    version = cache.get(ROOM_LIST_VERSION_KEY)
+    if version is None:
+        # Start from the clock so a version lost to eviction is never reused
+        version = int(time.time() * 1000)
+        cache.add(ROOM_LIST_VERSION_KEY, version, None)
+        version = cache.get(ROOM_LIST_VERSION_KEY, version)
+    return version
+
+
+def invalidate_room_lists():
+    """Retire every cached room listing once the current transaction commits."""
+    transaction.on_commit(_bump_room_list_version)
+
+
+def _bump_room_list_version():
+    try:
+        cache.incr(ROOM_LIST_VERSION_KEY)
+    except ValueError:
+        cache.set(ROOM_LIST_VERSION_KEY, int(time.time() * 1000), None)
+
+
+def add_members(room, user_ids):
+    """
+    Add the users among ``user_ids`` that exist and are not members yet.
+
+    Returns the ``(id, username)`` pairs that were added.
+    """
+    from django.contrib.auth.models import User
+    from .models import ChatRoom
+    through = ChatRoom.users.through
+    with transaction.atomic():
+        # Serializes bulk changes to the same room (a no-op on SQLite)
+        ChatRoom.objects.select_for_update().filter(id=room.id).first()
+        users = list(
+            User.objects.filter(id__in=set(user_ids))
+            .exclude(id__in=through.objects.filter(chatroom_id=room.id).values('user_id'))
+            .values_list('id', 'username')
+        )
+        through.objects.bulk_create(
+            [through(chatroom_id=room.id, user_id=user_id) for user_id, _ in users],
+            batch_size=settings.MEMBERSHIP_BULK_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        notify_members_changed(room.name, 'members_joined', users)
+        if users:
+            invalidate_room_lists()
+    return users
+
+
+def remove_members(room, user_ids):
+    """
+    Remove the members among ``user_ids``.
+
+    Returns the ``(id, username)`` pairs that were removed.
+    """
+    from django.contrib.auth.models import User
+    from .models import ChatRoom
+    through = ChatRoom.users.through
+    with transaction.atomic():
+        ChatRoom.objects.select_for_update().filter(id=room.id).first()
+        users = list(
+            User.objects.filter(id__in=set(user_ids), chat_rooms=room.id).values_list('id', 'username')
+        )
+        through.objects.filter(chatroom_id=room.id, user_id__in=[user_id for user_id, _ in users]).delete()
+        notify_members_changed(room.name, 'members_left', users)
+        if users:
+            invalidate_room_lists()
+    return users
+
+
+def _after_commit(room_name, event_type, payload):
+    transaction.on_commit(
+        lambda: _executor.submit(_dispatch, room_name, event_type, payload)
+    )
+
+
+def _dispatch(room_name, event_type, payload):
+    try:
+        async_to_sync(_group_send)(room_name, event_type, payload)
+    except Exception as e:
+        logger.warning("sending %s for room %s failed: %s", event_type, room_name, e)
+
+
+async def _group_send(room_name, event_type, payload):
+    channel_layer = get_channel_layer()
+    room_group_name = f'chat_{room_name}'
+    users = payload.get('users')
+    if users is None:
+        await channel_layer.group_send(room_group_name, {'type': event_type})
+        return
+    size = settings.MEMBERSHIP_EVENT_BATCH_SIZE
+    for start in range(0, len(users), size):
+        batch = users[start:start + size]
+        await channel_layer.group_send(
+            room_group_name,
+            {
+                'type': event_type,
+                'users': batch,
+                'payload': preencode({
+                    'type': event_type,
+                    'usernames': [user['username'] for user in batch],
+                    'room': room_name
+                })
+            }
+        )
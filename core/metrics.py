@@ -0,0 +1,164 @@
+"""
+In-process metrics in the Prometheus text format, served at ``/metrics``.
+
+Each worker process keeps its own registry; scrape every worker (or sum in
+the query) to see a whole deployment. Updates are a dict lookup and an add
+under a lock, cheap enough for the consumer hot path and safe from the
+executor threads ``database_sync_to_async`` runs on.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+_registry = []
+
+# Seconds; spans a Redis round trip to a slow database call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines += self._sample_lines(key, value)
+        return lines
+
+    def _sample_lines(self, key, value):
+        return [f'{self.name}{_labels(self.label_names, key)} {value}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        # Unlabelled gauges can be computed at scrape time instead
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key, 0) + amount
+            if value or not self.label_names:
+                self._values[key] = value
+            else:
+                # Drop label sets that reach zero, e.g. rooms nobody is in any more
+                self._values.pop(key, None)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def expose(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().expose()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), then the sum
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _sample_lines(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), state[:-1]):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_labels(self.label_names, key, [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {state[-1]}')
+        lines.append(f'{self.name}_count{_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+def expose():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+
+def _write_behind_pending():
+    from . import writer
+    return len(writer._writer._pending) if writer._writer is not None else 0
+
+
+CONNECTIONS = Counter('chat_connections_total', 'WebSocket connection attempts.', ['outcome'])
+DISCONNECTS = Counter('chat_disconnects_total', 'Closed WebSocket connections.')
+ACTIVE_CONNECTIONS = Gauge('chat_active_connections', 'Open connections in this worker.', ['room'])
+MESSAGES = Counter('chat_messages_total', 'Chat messages received from clients.')
+RATE_LIMITED = Counter('chat_rate_limited_total', 'Frames refused by the rate limits.')
+SLOW_CLIENTS = Counter('chat_slow_clients_dropped_total', 'Connections closed for not keeping up.')
+BROADCAST_LATENCY = Histogram(
+    'chat_receive_to_broadcast_seconds', 'Time from receiving a message to handing it to the channel layer.',
+)
+DB_CALL = Histogram('chat_db_call_seconds', 'Database calls made from async code.', ['method'])
+REDIS_CALL = Histogram('chat_redis_seconds', 'Redis round trips made by consumers.', ['operation'])
+CATCHUP_SIZE = Histogram(
+    'chat_catchup_messages', 'Unread messages sent to a client on connect.',
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000),
+)
+WRITE_BEHIND_PENDING = Gauge(
+    'chat_write_behind_pending', 'Messages waiting for the write-behind writer.', function=_write_behind_pending,
+)
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 17:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='core_message_room_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagequeue',
+            index=models.Index(condition=models.Q(('delivered', False)), fields=['user', 'room', 'message'], name='core_mq_undelivered_idx'),
+        ),
+    ]
@@ -0,0 +1,85 @@
+from django.db import DatabaseError, migrations
+
+# The inverted index over Message.content is maintained by the database itself:
+# an FTS5 table kept in sync by triggers on SQLite, a GIN expression index on
+# Postgres. Other backends have no index and core.search falls back to a scan.
+# Both indexes hold the room, so a search walks only its own room's hits: FTS5
+# indexes room_id as a column the MATCH filters on, Postgres gets a composite
+# (room_id, tsvector) GIN index.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE core_message_fts USING fts5(
+        room_id, content, content='core_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER core_message_fts_insert AFTER INSERT ON core_message BEGIN
+        INSERT INTO core_message_fts(rowid, room_id, content) VALUES (new.id, new.room_id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER core_message_fts_delete AFTER DELETE ON core_message BEGIN
+        INSERT INTO core_message_fts(core_message_fts, rowid, room_id, content)
+        VALUES ('delete', old.id, old.room_id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER core_message_fts_update AFTER UPDATE OF room_id, content ON core_message BEGIN
+        INSERT INTO core_message_fts(core_message_fts, rowid, room_id, content)
+        VALUES ('delete', old.id, old.room_id, old.content);
+        INSERT INTO core_message_fts(rowid, room_id, content) VALUES (new.id, new.room_id, new.content);
+    END
+    """,
+    "INSERT INTO core_message_fts(core_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS core_message_fts_update',
+    'DROP TRIGGER IF EXISTS core_message_fts_delete',
+    'DROP TRIGGER IF EXISTS core_message_fts_insert',
+    'DROP TABLE IF EXISTS core_message_fts',
+]
+
+POSTGRES_FORWARD = [
+    "CREATE INDEX core_message_room_content_fts ON core_message USING GIN (room_id, to_tsvector('simple', content))",
+]
+
+POSTGRES_BACKWARD = [
+    'DROP INDEX IF EXISTS core_message_room_content_fts',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return operation
+
+
+def create_btree_gin(apps, schema_editor):
+    # GIN over a plain integer column needs the btree_gin operator classes
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    except DatabaseError as e:
+        raise RuntimeError(
+            'Creating the btree_gin extension failed. It needs a superuser or a role '
+            'allowed to create extensions; have one run "CREATE EXTENSION btree_gin" '
+            'in this database, then migrate again.'
+        ) from e
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_message_segment'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_btree_gin, migrations.RunPython.noop),
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class ChatRoom(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -12,7 +14,25 @@ class Message(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: the write-behind writer stamps messages when they are sent,
+    # and bulk_create would otherwise overwrite that with the flush time
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        # The room timeline is read in id order; ids are assigned in insert order
+        indexes = [
+            models.Index(fields=['room', 'id'], name='core_message_room_id_idx'),
+            # Time range scans within a room, e.g. selecting messages by age
+            models.Index(fields=['room', 'timestamp', 'id'], name='core_message_room_ts_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.id is None and settings.CHAT_WRITE_BEHIND:
+            # Broadcast messages take ids from the writer's counter before they
+            # reach the table, so every other insert must draw from it as well
+            from .writer import next_message_id
+            self.id = next_message_id()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.user.username}: {self.content[:50]}'
@@ -29,7 +49,7 @@ class UserChatActivity(models.Model): #deprecated
         return f'{self.user.username} - {self.chat_room.name}'
     
 
-class ChatHistory(models.Model):
+class ChatHistory(models.Model): #deprecated, replaced by the Message timeline + ReadCursor
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     history = models.JSONField(default=list)  # Stores chat history as a JSON array
@@ -45,5 +65,48 @@ class MessageQueue(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE)
     delivered = models.BooleanField(default=False)  # Indicates whether the message has been delivered
 
+    class Meta:
+        # Only undelivered rows are ever looked up; delivered ones stay out of the index
+        indexes = [
+            models.Index(
+                fields=['user', 'room', 'message'],
+                condition=models.Q(delivered=False),
+                name='core_mq_undelivered_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} - {self.room.name} - {self.message.content[:50]}'
+
+
+class ReadCursor(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    last_read_id = models.BigIntegerField(default=0)  # Id of the newest Message the user has seen in the room
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'room')
+
+    def __str__(self):
+        return f'{self.user.username} - {self.room.name} @ {self.last_read_id}'
+
+
+class MessageSegment(models.Model):
+    # A run of archived messages of one room, moved out of Message by core.archive
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()  # zlib compressed JSON rows, oldest first
+
+    class Meta:
+        unique_together = ('room', 'first_id')
+        indexes = [
+            models.Index(fields=['room', 'last_id'], name='core_segment_room_last_idx'),
+        ]
+
     def __str__(self):
-        return f'{self.user.username} - {self.room.name} - {self.message.content[:50]}'
\ No newline at end of file
+        return f'{self.room.name} [{self.first_id}-{self.last_id}]'
@@ -0,0 +1,14 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pages over the primary key, newest first: each page is one indexed
+    range scan however deep the client has paged, and rows inserted meanwhile
+    do not shift the pages.
+    """
+    ordering = '-id'
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'limit'
+    max_page_size = settings.API_MAX_PAGE_SIZE
@@ -0,0 +1,77 @@
+"""
+Multi-device presence tracked in Redis.
+
+Every WebSocket connection is one member of two sorted sets, scored by the
+time its lease expires:
+
+- ``presence:user:{user_id}`` holds the user's connections, across all
+  workers and rooms, so one closed tab does not take the user offline;
+  ``connected_users`` counts them.
+- ``presence:room:{room_name}`` holds ``{user_id}:{connection}`` entries for
+  the connections open in that room.
+
+Consumers renew their lease every ``PRESENCE_HEARTBEAT_INTERVAL`` seconds.
+Entries left behind by a crashed worker simply stop counting once their
+lease runs out and are pruned on the next write.
+
+Presence fails open, like the rate limits: when Redis is unreachable the
+consumer logs it and carries on, and a user may briefly show as offline.
+"""
+import time
+
+from django.conf import settings
+
+from .metrics import REDIS_CALL
+from .redis_pool import get_redis
+
+
+def _user_key(user_id):
+    return f'presence:user:{user_id}'
+
+
+def _room_key(room_name):
+    return f'presence:room:{room_name}'
+
+
+async def touch(user_id, room_name, connection_id):
+    """Register or renew the lease of one connection."""
+    now = time.time()
+    expires = now + settings.PRESENCE_TTL
+    with REDIS_CALL.time(operation='presence_touch'):
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for key, member in (
+                (_user_key(user_id), connection_id),
+                (_room_key(room_name), f'{user_id}:{connection_id}'),
+            ):
+                pipe.zadd(key, {member: expires})
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.expire(key, settings.PRESENCE_TTL)
+            await pipe.execute()
+
+
+async def leave(user_id, room_name, connection_id):
+    with REDIS_CALL.time(operation='presence_leave'):
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.zrem(_user_key(user_id), connection_id)
+            pipe.zrem(_room_key(room_name), f'{user_id}:{connection_id}')
+            await pipe.execute()
+
+
+async def online_in_room(room_name):
+    """Ids of the users with at least one live connection in the room."""
+    members = await get_redis().zrangebyscore(_room_key(room_name), time.time(), '+inf')
+    return sorted({int(member.split(b':', 1)[0]) for member in members})
+
+
+async def connected_users(user_ids):
+    """Those of ``user_ids`` with a live connection in any room, in one round trip."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+    now = time.time()
+    with REDIS_CALL.time(operation='presence_connected'):
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(_user_key(user_id), now, '+inf')
+            counts = await pipe.execute()
+    return sorted(user_id for user_id, count in zip(user_ids, counts) if count)
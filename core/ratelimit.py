@@ -0,0 +1,70 @@
+"""
+Token-bucket rate limits shared by every worker through Redis.
+
+Each bucket is a Redis hash holding its token level and when it was last
+refilled. ``TAKE_TOKEN`` refills and checks all the buckets of a frame in one
+script, and only takes a token from each when all of them have one, so a frame
+refused by the room limit does not also use up the sender's allowance.
+"""
+import time
+
+from django.conf import settings
+
+from .metrics import REDIS_CALL
+from .redis_pool import get_redis
+
+# KEYS: bucket keys; ARGV[1]: now, then a rate and a burst per key.
+# Returns 0 when the frame may pass, else the seconds until it could
+TAKE_TOKEN = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+async def take(buckets):
+    """
+    Take one token from each of ``buckets``, a list of ``(key, rate, burst)``.
+
+    Returns 0 if the frame may pass, otherwise how many seconds to wait.
+    """
+    args = [time.time()]
+    for _, rate, burst in buckets:
+        args += [rate, burst]
+    with REDIS_CALL.time(operation='rate_limit'):
+        wait = await get_redis().eval(TAKE_TOKEN, len(buckets), *[key for key, _, _ in buckets], *args)
+    return float(wait)
+
+
+async def check_frame(user_id, room_name, is_message):
+    """
+    Rate limit one incoming frame. Every frame counts against the user; chat
+    messages, which are written and broadcast, also count against the room.
+    """
+    buckets = [(f'ratelimit:user:{user_id}', settings.CHAT_RATE_USER, settings.CHAT_RATE_USER_BURST)]
+    if is_message:
+        buckets.append((f'ratelimit:room:{room_name}', settings.CHAT_RATE_ROOM, settings.CHAT_RATE_ROOM_BURST))
+    return await take(buckets)
@@ -0,0 +1,45 @@
+"""
+Process-wide asyncio Redis client shared by every consumer.
+
+Connections are pooled per event loop (asyncio connections cannot be shared
+across loops); Daphne runs a single loop, so in practice each worker process
+holds exactly one pool. Synchronous code (views, the admin) gets a separate
+blocking client from ``get_sync_redis``.
+"""
+import asyncio
+import weakref
+
+import redis as sync_redis
+import redis.asyncio as redis
+from django.conf import settings
+
+_clients = weakref.WeakKeyDictionary()
+_sync_client = None
+
+
+def get_redis():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        pool = redis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+        )
+        client = redis.Redis(connection_pool=pool)
+        _clients[loop] = client
+    return client
+
+
+def get_sync_redis():
+    global _sync_client
+    if _sync_client is None:
+        # Thread-safe; shared by every request thread of the process
+        _sync_client = sync_redis.Redis(connection_pool=sync_redis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+        ))
+    return _sync_client
@@ -0,0 +1,83 @@
+"""
+Full-text search over a room's messages.
+
+The index is maintained by the database as messages are written (see
+migration 0011_message_search): an FTS5 table on SQLite, a GIN
+``(room_id, tsvector)`` index on Postgres. Both hold the room, so a search
+reads only its own room's hits. Hits are returned newest first and paged by
+message id, like history pages. Only messages in ``Message`` are searchable;
+archived ones are not.
+"""
+from django.conf import settings
+from django.db import connection
+
+from . import timeline
+from .models import Message
+
+# FTS5 walks its matches in rowid order itself, so the page stops after ``limit``
+# hits; the room is part of the MATCH (see ``fts5_query``)
+SQLITE_SEARCH = """
+    SELECT rowid FROM core_message_fts
+    WHERE core_message_fts MATCH %s AND rowid < %s
+    ORDER BY rowid DESC LIMIT %s
+"""
+
+POSTGRES_SEARCH = """
+    SELECT id FROM core_message
+    WHERE to_tsvector('simple', content) @@ plainto_tsquery('simple', %s) AND room_id = %s AND id < %s
+    ORDER BY id DESC LIMIT %s
+"""
+
+# Larger than any message id; stands in for a missing ``before``
+NO_CURSOR = 2 ** 63 - 1
+
+
+def fts5_query(room_id, text):
+    """
+    Match ``text`` in the content of one room's messages. Every term is quoted
+    so user input can never be parsed as FTS5 syntax.
+    """
+    terms = ' '.join('"{}"'.format(term.replace('"', '""')) for term in text.split())
+    return f'room_id : "{int(room_id)}" AND content : ({terms})'
+
+
+def _matching_ids(room_id, text, before, limit):
+    if connection.vendor == 'sqlite':
+        sql, params = SQLITE_SEARCH, [fts5_query(room_id, text), before, limit]
+    elif connection.vendor == 'postgresql':
+        sql, params = POSTGRES_SEARCH, [text, room_id, before, limit]
+    else:
+        return list(
+            Message.objects.filter(room_id=room_id, id__lt=before, content__icontains=text)
+            .order_by('-id')
+            .values_list('id', flat=True)[:limit]
+        )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_messages(room_id, text, before=None, limit=None):
+    """
+    Return one page of messages of a room matching ``text``, newest first.
+
+    ``cursor`` is the id to pass as ``before`` for the next page of hits.
+    """
+    limit = limit or settings.CHAT_HISTORY_PAGE_SIZE
+    if not text.strip():
+        return {'results': [], 'cursor': None, 'has_more': False}
+    ids = _matching_ids(room_id, text, before or NO_CURSOR, limit + 1)
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    messages = (
+        Message.objects.filter(id__in=ids)
+        .select_related('user')
+        .only('id', 'content', 'timestamp', 'user_id', 'user__username')
+        .order_by('-id')
+    )
+    results = [timeline.serialize_message(message) for message in messages]
+    return {
+        'results': results,
+        'cursor': results[-1]['id'] if results else None,
+        'has_more': has_more,
+    }
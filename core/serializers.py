@@ -1,12 +1,42 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import ChatRoom, Message, UserChatActivity, ChatHistory
 
-class ChatRoomSerializer(serializers.ModelSerializer):
+class FieldSelectionMixin:
+    """Return only the fields named in ``?fields=a,b`` when the request has it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        selected = request.query_params.get('fields') if request is not None else None
+        if selected:
+            wanted = {name.strip() for name in selected.split(',')}
+            for name, field in self.fields.items():
+                if name not in wanted:
+                    # Hidden from the output only; writable fields are still accepted
+                    field.write_only = True
+
+class ChatRoomSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    # Annotated by ChatRoomViewSet; the member list itself is only written, never listed
+    member_count = serializers.SerializerMethodField()
+
     class Meta:
         model = ChatRoom
-        fields = '__all__'
+        fields = ['id', 'name', 'member_count', 'users']
+        extra_kwargs = {'users': {'write_only': True, 'required': False}}
+
+    def get_member_count(self, room):
+        count = getattr(room, 'member_count', None)
+        return room.users.count() if count is None else count
+
+class MemberIdsSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.MEMBERSHIP_BULK_MAX_USERS,
+    )
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = '__all__'
@@ -1,73 +1,64 @@
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
-from django.db.models import ManyToManyField
-from .models import ChatRoom, UserChatActivity, ChatHistory, Message
+from .models import ChatRoom, Message
+from .membership import invalidate_room_lists, notify_members_changed, notify_membership_reset
+from .timeline import invalidate_history
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
-from datetime import timezone
 
 @receiver(m2m_changed, sender=ChatRoom.users.through)
-def notify_user_join(sender, instance, action, pk_set, **kwargs):
-    # Initialize channel_layer
-    channel_layer = get_channel_layer()
-    
+def notify_user_join(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('pre_clear', 'post_add', 'post_remove', 'post_clear'):
+        return
+    if action != 'pre_clear':
+        invalidate_room_lists()
+
     # Ensure channel_layer is valid before proceeding
-    if channel_layer is None:
+    if get_channel_layer() is None:
         raise ValueError("Channel layer is not configured. Ensure CHANNEL_LAYERS is properly set in settings.py")
 
-    room_name = instance.name
-    room_group_name = f'chat_{room_name}'
+    event_type = 'members_joined' if action == 'post_add' else 'members_left'
+
+    if reverse:
+        # user.chat_rooms changed: instance is the user, pk_set holds room ids
+        if action == 'pre_clear':
+            # clear() does not report which rooms were left; remember them now
+            instance._cleared_chat_rooms = list(instance.chat_rooms.values_list('name', flat=True))
+            return
+        if action == 'post_clear':
+            room_names = getattr(instance, '_cleared_chat_rooms', [])
+        else:
+            room_names = ChatRoom.objects.filter(id__in=pk_set).values_list('name', flat=True)
+        for room_name in room_names:
+            notify_members_changed(room_name, event_type, [(instance.id, instance.username)])
+        return
+
+    if action == 'post_clear':
+        # pk_set is not provided for clear(); connected members re-check themselves
+        notify_membership_reset(instance.name)
+    elif action in ('post_add', 'post_remove'):
+        # One query for all affected users, one batched event per room
+        users = User.objects.filter(id__in=pk_set).values_list('id', 'username')
+        notify_members_changed(instance.name, event_type, list(users))
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room_listings(sender, **kwargs):
+    invalidate_room_lists()
+
 
-    if action == 'post_add':
-        # Notify all users in the room about the new user
-        for user_id in pk_set:
-            user = User.objects.get(id=user_id)
-            async_to_sync(channel_layer.group_send)(
-                room_group_name,
-                {
-                    'type': 'user_joined',
-                    'username': user.username
-                }
-            )
-    
-    elif action == 'post_remove':
-        # Notify all users in the room about the user leaving
-        for user_id in pk_set:
-            user = User.objects.get(id=user_id)
-            async_to_sync(channel_layer.group_send)(
-                room_group_name,
-                {
-                    'type': 'user_left',
-                    'username': user.username
-                }
-            )
-import json
 @receiver(post_save, sender=Message)
-def update_chat_history(sender, instance, **kwargs):
-    # Prepare the new message for insertion into history
-    new_message = {
-        'user': instance.user.username,
-        'message': instance.content,
-        'timestamp': instance.timestamp.isoformat()
-    }
-    
-    # Update or create chat history for each user in the room
-    for user in instance.room.users.all():
-        try:
-            chat_history = ChatHistory.objects.get(chat_room=instance.room, user_id=user.id)
-            # Ensure history is a list, if not, initialize it
-            history = json.loads(chat_history.history) if chat_history.history else []
-            if not isinstance(history, list):
-                history = []
-        except ChatHistory.DoesNotExist:
-            history = []
-        
-        history.append(new_message)
-        
-        # Save the updated history
-        ChatHistory.objects.update_or_create(
-            chat_room=instance.room,
-            user_id=user.id,
-            defaults={'history': json.dumps(history)}
-        )
\ No newline at end of file
+def invalidate_edited_history(sender, instance, created, **kwargs):
+    # New messages change the room's latest id, which history ETags already use
+    if not created:
+        invalidate_history(instance.room_id)
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_deleted_history(sender, instance, origin=None, **kwargs):
+    # A queryset delete (archiving, the admin) reports every row; bump each room once
+    rooms = origin.__dict__.setdefault('_invalidated_history', set()) if origin is not None else set()
+    if instance.room_id not in rooms:
+        rooms.add(instance.room_id)
+        invalidate_history(instance.room_id)
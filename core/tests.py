@@ -1,3 +1,1069 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import unittest
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+import redis.asyncio as redis
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import (
+    archive, membership, metrics, presence, protocol, ratelimit, routing, search, timeline, views, workers, writer,
+)
+from .auth import JWTAuthMiddleware, TTLCache, has_session, membership_cache, session_token
+from .db import db_sync_to_async
+from .layers import HashRing, LocalFanoutChannelLayer, ShardedRedisChannelLayer
+from .models import ChatRoom, Message, MessageQueue, MessageSegment
+
+
+class HashRingTests(SimpleTestCase):
+    keys = [f'chat_room{i}' for i in range(2000)]
+
+    def owners(self, nodes):
+        ring = HashRing(nodes)
+        return {key: nodes[ring.get(key)] for key in self.keys}
+
+    def test_owner_does_not_depend_on_host_order(self):
+        nodes = ['redis://a:6379', 'redis://b:6379', 'redis://c:6379']
+        self.assertEqual(self.owners(nodes), self.owners(list(reversed(nodes))))
+
+    def test_keys_spread_over_all_nodes(self):
+        nodes = ['redis://a:6379', 'redis://b:6379', 'redis://c:6379', 'redis://d:6379']
+        counts = {}
+        for owner in self.owners(nodes).values():
+            counts[owner] = counts.get(owner, 0) + 1
+        self.assertEqual(set(counts), set(nodes))
+        self.assertGreater(min(counts.values()), len(self.keys) / len(nodes) / 2)
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        nodes = ['redis://a:6379', 'redis://b:6379', 'redis://c:6379']
+        before = self.owners(nodes)
+        after = self.owners(nodes + ['redis://d:6379'])
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'redis://d:6379' for key in moved))
+        self.assertLess(len(moved), len(self.keys) / 2)
+
+
+@unittest.skipUnless(
+    os.getenv('CHAT_TEST_REDIS_HOSTS'),
+    'set CHAT_TEST_REDIS_HOSTS to a comma separated list of redis:// URLs',
+)
+class ShardedChannelLayerTests(SimpleTestCase):
+    """Runs against real Redis nodes, e.g. several local redis-server processes."""
+
+    def setUp(self):
+        hosts = os.getenv('CHAT_TEST_REDIS_HOSTS').split(',')
+        self.layer = ShardedRedisChannelLayer(hosts=hosts, prefix='test-sharding')
+
+    def tearDown(self):
+        async_to_sync(self.layer.flush)()
+
+    def test_group_send_reaches_every_member(self):
+        async def run():
+            channels = [await self.layer.new_channel() for _ in range(5)]
+            for room in range(20):
+                for channel in channels:
+                    await self.layer.group_add(f'chat_room{room}', channel)
+            await self.layer.group_send('chat_room7', {'type': 'chat_message', 'text': 'hi'})
+            return [await self.layer.receive(channel) for channel in channels]
+
+        for message in async_to_sync(run)():
+            self.assertEqual(message['text'], 'hi')
+
+    def test_send_to_specific_channel(self):
+        async def run():
+            channels = [await self.layer.new_channel() for _ in range(5)]
+            for channel in channels:
+                await self.layer.send(channel, {'type': 'chat_message', 'text': channel})
+            return channels, [await self.layer.receive(channel) for channel in channels]
+
+        channels, messages = async_to_sync(run)()
+        self.assertEqual([message['text'] for message in messages], channels)
+
+    def test_groups_use_more_than_one_node(self):
+        indexes = {self.layer.consistent_hash(f'chat_room{room}') for room in range(100)}
+        self.assertEqual(indexes, set(range(self.layer.ring_size)))
+
+
+@unittest.skipUnless(
+    os.getenv('CHAT_TEST_REDIS_HOSTS'),
+    'set CHAT_TEST_REDIS_HOSTS to a comma separated list of redis:// URLs',
+)
+class LocalFanoutChannelLayerTests(SimpleTestCase):
+    """Two layer instances stand in for two worker processes."""
+
+    def setUp(self):
+        hosts = os.getenv('CHAT_TEST_REDIS_HOSTS').split(',')
+        self.local = LocalFanoutChannelLayer(hosts=hosts, prefix='test-fanout')
+        self.remote = LocalFanoutChannelLayer(hosts=hosts, prefix='test-fanout')
+
+    def tearDown(self):
+        async_to_sync(self.local.flush)()
+        async_to_sync(self.remote.flush)()
+
+    def test_group_send_reaches_local_and_remote_members(self):
+        async def run():
+            local = [await self.local.new_channel() for _ in range(3)]
+            remote = [await self.remote.new_channel() for _ in range(2)]
+            for channel in local:
+                await self.local.group_add('chat_room', channel)
+            for channel in remote:
+                await self.remote.group_add('chat_room', channel)
+            await self.local.group_send('chat_room', {'type': 'chat_message', 'text': 'hi'})
+            received = [await self.local.receive(channel) for channel in local]
+            received += [await self.remote.receive(channel) for channel in remote]
+            return received
+
+        received = async_to_sync(run)()
+        self.assertEqual([message['text'] for message in received], ['hi'] * 5)
+
+    def test_redis_group_holds_one_entry_per_worker(self):
+        async def run():
+            for _ in range(3):
+                await self.local.group_add('chat_room', await self.local.new_channel())
+            await self.remote.group_add('chat_room', await self.remote.new_channel())
+            connection = self.local.connection(self.local.consistent_hash('chat_room'))
+            return await connection.zrange(self.local._group_key('chat_room'), 0, -1)
+
+        members = sorted(member.decode() for member in async_to_sync(run)())
+        self.assertEqual(members, sorted([
+            self.local.fanout_channel('chat_room'),
+            self.remote.fanout_channel('chat_room'),
+        ]))
+
+    def test_local_delivery_skips_redis(self):
+        async def run():
+            channel = await self.local.new_channel()
+            await self.local.group_add('chat_room', channel)
+            await self.local.group_send('chat_room', {'type': 'chat_message', 'text': 'hi'})
+            own_key = self.local.prefix + self.local.non_local_name(channel)
+            connection = self.local.connection(self.local.consistent_hash(channel))
+            return await connection.exists(own_key), await self.local.receive(channel)
+
+        queued_in_redis, message = async_to_sync(run)()
+        self.assertFalse(queued_in_redis)
+        self.assertEqual(message['text'], 'hi')
+
+    def test_waiting_receiver_wakes_up_for_local_delivery(self):
+        async def run():
+            channel = await self.local.new_channel()
+            # Already blocked on Redis when the message is delivered in memory
+            receiving = asyncio.ensure_future(self.local.receive(channel))
+            await self.local.group_add('chat_room', channel)
+            await asyncio.sleep(0.1)
+            await self.local.group_send('chat_room', {'type': 'chat_message', 'text': 'hi'})
+            return await asyncio.wait_for(receiving, 1)
+
+        self.assertEqual(async_to_sync(run)()['text'], 'hi')
+
+    def test_long_group_names_fit_in_a_channel_name(self):
+        group = 'chat_' + 'r' * 94
+
+        async def run():
+            local = await self.local.new_channel()
+            remote = await self.remote.new_channel()
+            await self.local.group_add(group, local)
+            await self.remote.group_add(group, remote)
+            await self.local.group_send(group, {'type': 'chat_message', 'text': 'hi'})
+            return await self.local.receive(local), await self.remote.receive(remote)
+
+        self.assertTrue(self.local.valid_channel_name(self.local.fanout_channel(group)))
+        self.assertEqual([message['text'] for message in async_to_sync(run)()], ['hi', 'hi'])
+
+
+@unittest.skipUnless(
+    os.getenv('CHAT_TEST_REDIS_HOSTS'),
+    'set CHAT_TEST_REDIS_HOSTS to a comma separated list of redis:// URLs',
+)
+class RateLimitTests(SimpleTestCase):
+    def take(self, buckets):
+        async def run():
+            client = redis.from_url(os.getenv('CHAT_TEST_REDIS_HOSTS').split(',')[0])
+            try:
+                with mock.patch.object(ratelimit, 'get_redis', return_value=client):
+                    return await ratelimit.take(buckets)
+            finally:
+                await client.aclose()
+
+        return async_to_sync(run)()
+
+    def setUp(self):
+        self.user = (f'test:ratelimit:user:{self.id()}', 1, 2)
+        self.room = (f'test:ratelimit:room:{self.id()}', 1, 1)
+
+    def test_burst_then_refusal(self):
+        self.assertEqual(self.take([self.user]), 0)
+        self.assertEqual(self.take([self.user]), 0)
+        wait = self.take([self.user])
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+
+    def test_refused_frame_takes_no_token_from_other_buckets(self):
+        self.assertEqual(self.take([self.user, self.room]), 0)
+        self.assertGreater(self.take([self.user, self.room]), 0)
+        # The room refused the second frame, so the user still has one token left
+        self.assertEqual(self.take([self.user]), 0)
+        self.assertGreater(self.take([self.user]), 0)
+
+
+@unittest.skipUnless(
+    os.getenv('CHAT_TEST_REDIS_HOSTS'),
+    'set CHAT_TEST_REDIS_HOSTS to a comma separated list of redis:// URLs',
+)
+class PresenceTests(SimpleTestCase):
+    def run_with_redis(self, coroutine_function):
+        async def run():
+            client = redis.from_url(os.getenv('CHAT_TEST_REDIS_HOSTS').split(',')[0])
+            try:
+                with mock.patch.object(presence, 'get_redis', return_value=client):
+                    return await coroutine_function()
+            finally:
+                await client.aclose()
+
+        return async_to_sync(run)()
+
+    def test_user_stays_connected_until_the_last_connection_leaves(self):
+        async def run():
+            await presence.touch(901, 'lobby', 'tab-1')
+            await presence.touch(901, 'other', 'tab-2')
+            states = [await presence.connected_users([901, 902])]
+            await presence.leave(901, 'lobby', 'tab-1')
+            states.append(await presence.connected_users([901, 902]))
+            await presence.leave(901, 'other', 'tab-2')
+            states.append(await presence.connected_users([901, 902]))
+            return states
+
+        self.assertEqual(self.run_with_redis(run), [[901], [901], []])
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'uses EXPLAIN QUERY PLAN')
+class HotQueryPlanTests(TestCase):
+    """Each hot query must be answered from an index, without a scan or a sort."""
+
+    tables = ('core_message', 'core_messagequeue', 'core_messagesegment', 'core_readcursor')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice')
+        cls.room = ChatRoom.objects.create(name='lobby')
+        for i in range(5):
+            timeline.append_message(cls.user, cls.room, f'message {i}')
+
+    def assertIndexed(self, run):
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        for sql in selects:
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                plan = [row[-1] for row in cursor.fetchall()]
+            for step in plan:
+                with self.subTest(sql=sql, step=step):
+                    self.assertNotIn('TEMP B-TREE', step)
+                    self.assertFalse(
+                        step.startswith('SCAN') and any(table in step for table in self.tables)
+                    )
+
+    def test_history_pages(self):
+        self.assertIndexed(lambda: timeline.history_page(self.room.id))
+        self.assertIndexed(lambda: timeline.history_page(self.room.id, before=3))
+        self.assertIndexed(lambda: timeline.history_page(self.room.id, after=2))
+
+    def test_user_view_and_read_cursor(self):
+        self.assertIndexed(lambda: timeline.user_view(self.room.id, self.user.id))
+        self.assertIndexed(lambda: timeline.mark_read(self.user.id, self.room.id, 3))
+        self.assertIndexed(lambda: timeline.get_read_cursor(self.user.id, self.room.id))
+
+    def test_latest_message(self):
+        self.assertIndexed(lambda: timeline.latest_message(self.room.id))
+
+    def test_messages_by_age(self):
+        self.assertIndexed(lambda: list(
+            self.room.message_set.filter(timestamp__lt=timezone.now()).order_by('timestamp', 'id')[:10]
+        ))
+
+    def test_undelivered_queue(self):
+        self.assertIndexed(lambda: list(
+            MessageQueue.objects.filter(user=self.user, room=self.room, delivered=False)
+        ))
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice')
+        cls.room = ChatRoom.objects.create(name='lobby')
+        cls.ids = [timeline.append_message(cls.user, cls.room, f'message {i}').id for i in range(10)]
+        # The first seven are old enough to archive
+        Message.objects.filter(id__in=cls.ids[:7]).update(timestamp=timezone.now() - timedelta(days=365))
+
+    def walk(self, **kwargs):
+        page = timeline.history_page(self.room.id, limit=3, **kwargs)
+        ids = [row['id'] for row in page['history']]
+        while page['has_more']:
+            if 'after' in kwargs:
+                page = timeline.history_page(self.room.id, after=page['next_cursor'], limit=3)
+                ids += [row['id'] for row in page['history']]
+            else:
+                page = timeline.history_page(self.room.id, before=page['cursor'], limit=3)
+                ids[:0] = [row['id'] for row in page['history']]
+        return ids
+
+    def test_old_messages_move_to_segments(self):
+        moved = archive.archive_room(self.room.id, archive.archive_cutoff(30), segment_size=3)
+        self.assertEqual(moved, 7)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True).order_by('id')), self.ids[7:])
+        self.assertEqual(
+            list(MessageSegment.objects.order_by('first_id').values_list('count', flat=True)), [3, 3, 1]
+        )
+
+    def test_history_reads_fall_through_to_the_archive(self):
+        before = timeline.fetch_page(self.room.id, limit=50)
+        archive.archive_room(self.room.id, archive.archive_cutoff(30), segment_size=3)
+        self.assertEqual(timeline.fetch_page(self.room.id, limit=50), before)
+        self.assertEqual(self.walk(), self.ids)
+        self.assertEqual(self.walk(after=0), self.ids)
+
+    def test_latest_message_of_a_fully_archived_room(self):
+        archive.archive_room(self.room.id, timezone.now() + timedelta(days=1))
+        self.assertEqual(timeline.latest_message(self.room.id)[0], self.ids[-1])
+
+
+class HistoryConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice')
+        cls.room = ChatRoom.objects.create(name='lobby')
+        cls.ids = [timeline.append_message(cls.user, cls.room, f'message {i}').id for i in range(3)]
+
+    def setUp(self):
+        self.url = f'/api/chat_history/{self.room.name}/{self.user.id}/'
+        self.etag = self.client.get(self.url).headers['ETag']
+
+    def assertChanged(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], self.etag)
+
+    def test_unchanged_room_is_not_modified(self):
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag).status_code, 304)
+
+    def test_edit_changes_the_etag(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.get(id=self.ids[0])
+            message.content = 'edited'
+            message.save()
+        self.assertChanged()
+
+    def test_delete_changes_the_etag(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(id=self.ids[0]).delete()
+        self.assertChanged()
+
+    def test_archive_changes_the_etag(self):
+        Message.objects.filter(room=self.room).update(timestamp=timezone.now() - timedelta(days=365))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            archive.archive_room(self.room.id, archive.archive_cutoff(30), segment_size=2)
+        # One version bump per deleted segment, not per message
+        self.assertEqual(len(callbacks), 2)
+        self.assertChanged()
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice')
+        cls.room = ChatRoom.objects.create(name='lobby')
+        cls.room.users.add(cls.user)
+        cls.other = ChatRoom.objects.create(name='other')
+        cls.hits = [timeline.append_message(cls.user, cls.room, f'deploy number {i}').id for i in range(5)]
+        timeline.append_message(cls.user, cls.room, 'lunch?')
+        timeline.append_message(cls.user, cls.other, 'deploy elsewhere')
+
+    def test_hits_are_scoped_to_the_room_and_paged_newest_first(self):
+        page = search.search_messages(self.room.id, 'deploy', limit=3)
+        ids = [row['id'] for row in page['results']]
+        self.assertTrue(page['has_more'])
+        page = search.search_messages(self.room.id, 'deploy', before=page['cursor'], limit=3)
+        ids += [row['id'] for row in page['results']]
+        self.assertFalse(page['has_more'])
+        self.assertEqual(ids, self.hits[::-1])
+
+    def test_index_follows_edits_and_deletes(self):
+        Message.objects.filter(id=self.hits[0]).update(content='rollback')
+        Message.objects.filter(id=self.hits[1]).delete()
+        self.assertEqual(len(search.search_messages(self.room.id, 'deploy')['results']), 3)
+        self.assertEqual(len(search.search_messages(self.room.id, 'rollback')['results']), 1)
+
+    def test_terms_match_content_not_the_room(self):
+        self.assertEqual(search.search_messages(self.other.id, str(self.other.id))['results'], [])
+        other = search.search_messages(self.other.id, 'deploy')['results']
+        self.assertEqual([row['message'] for row in other], ['deploy elsewhere'])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(search.search_messages(self.room.id, 'lunch? OR "NEAR(')['results'], [])
+        self.assertEqual(len(search.search_messages(self.room.id, 'lunch?')['results']), 1)
+
+    def test_search_endpoint_requires_membership(self):
+        url = f'/api/chatrooms/{self.room.id}/search/?q=deploy&limit=2'
+        outsider = User.objects.create(username='mallory')
+        for user, status in ((outsider, 403), (self.user, 200)):
+            token = RefreshToken.for_user(user).access_token
+            response = self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {token}')
+            self.assertEqual(response.status_code, status)
+        self.assertEqual([row['id'] for row in response.json()['results']], self.hits[:-3:-1])
+
+
+class BulkMembershipTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.room = ChatRoom.objects.create(name='onboarding')
+        cls.users = User.objects.bulk_create([User(username=f'new_{i}') for i in range(50)])
+        cls.room.users.add(cls.users[0])
+
+    def post(self, action, user_ids):
+        token = RefreshToken.for_user(self.users[0]).access_token
+        return self.client.post(
+            f'/api/chatrooms/{self.room.id}/members/{action}/', {'user_ids': user_ids},
+            content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}',
+        )
+
+    def test_add_and_remove_announce_once(self):
+        ids = [user.id for user in self.users]
+        with mock.patch.object(membership, '_after_commit') as after_commit:
+            # Existing members and unknown ids are skipped
+            response = self.post('add', ids + [10 ** 6])
+            self.assertEqual(sorted(response.json()['added']), ids[1:])
+            self.assertEqual(self.room.users.count(), 50)
+            response = self.post('remove', ids[:10])
+            self.assertEqual(sorted(response.json()['removed']), ids[:10])
+        self.assertEqual(self.room.users.count(), 40)
+        self.assertEqual(
+            [(call.args[1], len(call.args[2]['users'])) for call in after_commit.call_args_list],
+            [('members_joined', 49), ('members_left', 10)],
+        )
+
+    def test_payload_is_validated(self):
+        self.assertEqual(self.post('add', []).status_code, 400)
+        self.assertEqual(self.post('remove', ['bob']).status_code, 400)
+
+
+class RoomListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice')
+        cls.rooms = ChatRoom.objects.bulk_create([ChatRoom(name=f'room_{i}') for i in range(5)])
+        ChatRoom.users.through.objects.bulk_create(
+            [ChatRoom.users.through(chatroom_id=room.id, user_id=cls.user.id) for room in cls.rooms[:3]]
+        )
+
+    def get(self, url='/api/chatrooms/'):
+        token = RefreshToken.for_user(self.user).access_token
+        return self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {token}').json()
+
+    def test_cursor_pages_with_member_counts(self):
+        page = self.get('/api/chatrooms/?limit=3')
+        self.assertEqual([row['name'] for row in page['results']], ['room_4', 'room_3', 'room_2'])
+        self.assertEqual(page['results'][2], {'id': self.rooms[2].id, 'name': 'room_2', 'member_count': 1})
+        # The requesting user, then one grouped query for the page
+        with self.assertNumQueries(2):
+            rest = self.get(page['next'])
+        self.assertEqual([row['member_count'] for row in rest['results']], [1, 1])
+        self.assertEqual(self.get('/api/chatrooms/?fields=name&limit=1')['results'], [{'name': 'room_4'}])
+
+    def test_listing_is_cached_until_membership_changes(self):
+        self.assertEqual(self.get()['results'][0]['member_count'], 0)
+        ChatRoom.users.through.objects.create(chatroom_id=self.rooms[4].id, user_id=self.user.id)
+        self.assertEqual(self.get()['results'][0]['member_count'], 0)
+        with mock.patch.object(membership, '_after_commit'), self.captureOnCommitCallbacks(execute=True):
+            self.rooms[4].users.add(User.objects.create(username='bob'))
+        self.assertEqual(self.get()['results'][0]['member_count'], 2)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ['method'], buckets=(0.1, 1))
+        metrics._registry.remove(histogram)
+        histogram.observe(0.05, method='a')
+        histogram.observe(0.5, method='a')
+        histogram.observe(5, method='a')
+        self.assertEqual(histogram.expose()[2:], [
+            'test_seconds_bucket{method="a",le="0.1"} 1',
+            'test_seconds_bucket{method="a",le="1"} 2',
+            'test_seconds_bucket{method="a",le="+Inf"} 3',
+            'test_seconds_sum{method="a"} 5.55',
+            'test_seconds_count{method="a"} 3',
+        ])
+
+    def test_gauge_drops_label_sets_at_zero(self):
+        gauge = metrics.Gauge('test_connections', 'Test.', ['room'])
+        metrics._registry.remove(gauge)
+        gauge.inc(room='lobby')
+        gauge.dec(room='lobby')
+        self.assertEqual(gauge.expose()[2:], [])
+
+    def test_endpoint_is_closed_without_a_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+    def test_staff_may_read_the_endpoint(self):
+        request = RequestFactory().get('/metrics')
+        request.user = mock.Mock(is_staff=True)
+        self.assertEqual(views.metrics_view(request).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_requires_the_token_when_set(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE chat_connections_total counter', response.content.decode())
+
+
+class ProtocolTests(SimpleTestCase):
+    frame = {
+        'type': 'chat_history',
+        'history': [{'id': 1, 'message': 'hi', 'username': 'alice', 'user_id': 7, 'timestamp': 't'}],
+        'cursor': 1,
+        'next_cursor': 1,
+        'has_more': False,
+    }
+
+    def test_msgpack_is_negotiated_only_when_offered(self):
+        self.assertIsInstance(protocol.negotiate({}), protocol.JsonCodec)
+        self.assertIsInstance(protocol.negotiate({'subprotocols': ['chat.v0']}), protocol.JsonCodec)
+        codec = protocol.negotiate({'subprotocols': ['chat.v0', protocol.MSGPACK_SUBPROTOCOL]})
+        self.assertIsInstance(codec, protocol.MsgpackCodec)
+        self.assertEqual(codec.subprotocol, protocol.MSGPACK_SUBPROTOCOL)
+
+    def test_short_keys_round_trip(self):
+        codec = protocol.MsgpackCodec()
+        packed = codec.encode(self.frame)['bytes_data']
+        self.assertEqual(
+            msgpack.unpackb(packed),
+            {'t': 'chat_history', 'h': [{'i': 1, 'm': 'hi', 'u': 'alice', 'ui': 7, 'ts': 't'}],
+             'c': 1, 'nc': 1, 'hm': False},
+        )
+        self.assertEqual(codec.decode(bytes_data=packed), self.frame)
+
+    def test_preencoded_payload_matches_each_codec(self):
+        payload = protocol.preencode(self.frame)
+        self.assertEqual(protocol.JsonCodec().encoded(payload), protocol.JsonCodec().encode(self.frame))
+        self.assertEqual(protocol.MsgpackCodec().encoded(payload), protocol.MsgpackCodec().encode(self.frame))
+
+    def test_msgpack_codec_decodes_client_frames(self):
+        codec = protocol.MsgpackCodec()
+        request = msgpack.packb({'t': 'history', 'b': 10, 'l': 5})
+        self.assertEqual(codec.decode(bytes_data=request), {'type': 'history', 'before': 10, 'limit': 5})
+        # A stray JSON text frame is still understood
+        self.assertEqual(codec.decode(text_data='{"type": "presence"}'), {'type': 'presence'})
+
+    def test_frames_that_are_not_objects_are_rejected(self):
+        with self.assertRaisesMessage(protocol.InvalidFrame, 'Frames must be objects.'):
+            protocol.JsonCodec().decode(text_data='[1, 2]')
+        with self.assertRaises(protocol.InvalidFrame):
+            protocol.MsgpackCodec().decode(bytes_data=msgpack.packb([1, 2]))
+
+    def test_messages_that_are_not_strings_are_rejected(self):
+        codec = protocol.MsgpackCodec()
+        for message in (5, b'x', None):
+            with self.subTest(message=message):
+                with self.assertRaisesMessage(protocol.InvalidFrame, 'Messages must be strings.'):
+                    codec.decode(bytes_data=msgpack.packb({'m': message}))
+        with self.assertRaises(protocol.InvalidFrame):
+            protocol.JsonCodec().decode(text_data='{"message": 5}')
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_entries_expire(self):
+        cache = TTLCache(maxsize=2, ttl=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class JWTAuthMiddlewareTests(SimpleTestCase):
+    def scope_for(self, **scope):
+        seen = {}
+
+        async def inner(scope, receive, send):
+            seen.update(scope)
+
+        async_to_sync(JWTAuthMiddleware(inner))({'type': 'websocket', **scope}, None, None)
+        return seen
+
+    def test_token_from_query_string_or_header(self):
+        token = str(RefreshToken.for_user(User(id=7)).access_token)
+        self.assertEqual(self.scope_for(query_string=f'token={token}'.encode())['token_user_id'], 7)
+        headers = [(b'authorization', f'Bearer {token}'.encode())]
+        self.assertEqual(self.scope_for(headers=headers)['token_user_id'], 7)
+
+    def test_invalid_token(self):
+        scope = self.scope_for(query_string=b'token=garbage')
+        self.assertNotIn('token_user_id', scope)
+        self.assertIn('token_error', scope)
+
+    def test_no_token(self):
+        scope = self.scope_for(query_string=b'')
+        self.assertNotIn('token_user_id', scope)
+        self.assertNotIn('token_error', scope)
+
+
+class SessionTokenTests(SimpleTestCase):
+    def scope_for(self, token):
+        return {'query_string': f'session={token}&last_id=5'.encode()}
+
+    def test_token_is_bound_to_its_user_and_room(self):
+        token = session_token(7, 'lobby')
+        self.assertTrue(has_session(self.scope_for(token), 7, 'lobby'))
+        self.assertFalse(has_session(self.scope_for(token), 8, 'lobby'))
+        self.assertFalse(has_session(self.scope_for(token), 7, 'other'))
+        self.assertFalse(has_session(self.scope_for(token[:-2]), 7, 'lobby'))
+        self.assertFalse(has_session({}, 7, 'lobby'))
+
+    @override_settings(CHAT_SESSION_MAX_AGE=-1)
+    def test_expired_token(self):
+        self.assertFalse(has_session(self.scope_for(session_token(7, 'lobby')), 7, 'lobby'))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ConsumerTestCase(TransactionTestCase):
+    """ChatConsumer over the in-memory layer, with Redis presence and rate limits stubbed out."""
+
+    application = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+
+    def setUp(self):
+        membership_cache.clear()
+        self.retry_after = 0
+        for target, stub in (
+            ('core.presence.touch', mock.AsyncMock()),
+            ('core.presence.leave', mock.AsyncMock()),
+            ('core.ratelimit.check_frame', mock.AsyncMock(side_effect=lambda *args: self.retry_after)),
+        ):
+            patcher = mock.patch(target, stub)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='alice')
+        self.room = ChatRoom.objects.create(name='lobby')
+        self.room.users.add(self.user)
+
+    async def connect(self, query='', **kwargs):
+        communicator = WebsocketCommunicator(
+            self.application, f'/ws/chat/{self.room.name}/{self.user.id}/{query}', **kwargs,
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def frames(self, communicator, until=None):
+        """
+        Decoded frames sent until one of type ``until`` arrives, or else until
+        the consumer goes quiet; a close ends the list.
+        """
+        frames = []
+        while until is not None or not await communicator.receive_nothing(timeout=0.2):
+            output = await communicator.receive_output(timeout=5)
+            if output['type'] == 'websocket.close':
+                frames.append(output)
+                break
+            if 'text' in output:
+                frames.append(json.loads(output['text']))
+            else:
+                frames.append(protocol.MsgpackCodec().decode(bytes_data=output['bytes']))
+            if frames[-1].get('type') == until:
+                break
+        return frames
+
+    def post(self, content):
+        return timeline.append_message(self.user, self.room, content).id
+
+
+class SessionResumeTests(ConsumerTestCase):
+    async def test_resume_sends_only_the_delta(self):
+        communicator = await self.connect()
+        frames = await self.frames(communicator, until='session')
+        self.assertEqual([frame['type'] for frame in frames], ['chat_history', 'session'])
+        last_id = await sync_to_async(self.post)('seen')
+        await communicator.disconnect()
+
+        missed = [await sync_to_async(self.post)(f'missed {i}') for i in range(2)]
+        communicator = await self.connect(f"?session={frames[1]['token']}&last_id={last_id}")
+        frames = await self.frames(communicator, until='session')
+        self.assertEqual([frame['type'] for frame in frames], ['chat_catchup', 'session'])
+        self.assertEqual([row['id'] for row in frames[0]['history']], missed)
+        await communicator.disconnect()
+
+    async def test_removed_member_cannot_resume(self):
+        communicator = await self.connect()
+        token = (await self.frames(communicator, until='session'))[-1]['token']
+        await communicator.disconnect()
+
+        with mock.patch.object(membership, '_after_commit'):
+            await sync_to_async(self.room.users.remove)(self.user)
+        communicator = await self.connect(f'?session={token}&last_id=1')
+        frames = await self.frames(communicator)
+        self.assertEqual(frames[0]['type'], 'error')
+        self.assertEqual(frames[-1]['type'], 'websocket.close')
+        self.assertNotIn('session', [frame.get('type') for frame in frames[:-1]])
+
+
+class DatabaseThreadTests(SimpleTestCase):
+    def test_thread_sensitivity_follows_the_setting(self):
+        def query():
+            pass
+
+        for thread_sensitive in (True, False):
+            with self.subTest(thread_sensitive=thread_sensitive), \
+                    override_settings(DATABASE_THREAD_SENSITIVE=thread_sensitive):
+                self.assertIs(db_sync_to_async(query)._thread_sensitive, thread_sensitive)
+
+
+class BenchDbTests(TransactionTestCase):
+    def test_benchdb_runs_and_cleans_up(self):
+        out = io.StringIO()
+        call_command('benchdb', writers='1,2', messages=3, stdout=out)
+        self.assertEqual(out.getvalue().count('inserts=6'), 1)
+        self.assertEqual(out.getvalue().count('inserts=3'), 1)
+        self.assertFalse(Message.objects.filter(room__name='benchdb').exists())
+
+
+class MessageWriterTests(TransactionTestCase):
+    """The write-behind writer with its Redis calls stubbed out."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.room = ChatRoom.objects.create(name='lobby')
+        self.ids = iter(range(1000, 2000))
+
+    def make_writer(self, batch_size=2, flush_interval=60, max_pending=10):
+        message_writer = writer.MessageWriter(batch_size, flush_interval, max_pending)
+        for name, stub in (
+            ('_allocate_id', mock.AsyncMock(side_effect=lambda expires: next(self.ids))),
+            ('_release', mock.AsyncMock()),
+            ('_hold', mock.AsyncMock()),
+            ('_seed_counter', mock.AsyncMock()),
+        ):
+            setattr(message_writer, name, stub)
+        return message_writer
+
+    def stored_ids(self):
+        return list(Message.objects.order_by('id').values_list('id', flat=True))
+
+    async def test_flush_writes_in_batches(self):
+        message_writer = self.make_writer(batch_size=2)
+        sizes = []
+        persist_batch = writer.persist_batch
+
+        def persist(batch):
+            sizes.append(len(batch))
+            return persist_batch(batch)
+
+        with mock.patch.object(writer, 'persist_batch', persist):
+            for i in range(5):
+                await message_writer.submit(self.user, self.room, f'm{i}')
+            await message_writer.close()
+        self.assertEqual(sorted(sizes), [1, 2, 2])
+        self.assertEqual(await sync_to_async(self.stored_ids)(), list(range(1000, 1005)))
+        self.assertEqual(message_writer._release.await_count, 3)
+
+    async def test_submit_waits_for_room_when_full(self):
+        message_writer = self.make_writer(batch_size=10, max_pending=2)
+        for i in range(2):
+            await message_writer.submit(self.user, self.room, f'm{i}')
+        self.assertEqual(await sync_to_async(self.stored_ids)(), [])
+        # The third message is only taken once the first two are written
+        await asyncio.wait_for(message_writer.submit(self.user, self.room, 'm2'), 5)
+        self.assertEqual(await sync_to_async(self.stored_ids)(), [1000, 1001])
+        await message_writer.close()
+
+    async def test_failed_flush_keeps_the_batch_for_a_retry(self):
+        message_writer = self.make_writer()
+        await message_writer.submit(self.user, self.room, 'kept')
+        def persist(batch):
+            raise RuntimeError('database down')
+
+        with mock.patch.object(writer, 'persist_batch', persist):
+            with self.assertLogs('core.writer', 'ERROR'):
+                await message_writer.flush()
+        self.assertEqual(len(message_writer._pending), 1)
+        message_writer._hold.assert_awaited_once()
+        message_writer._release.assert_not_awaited()
+
+        await message_writer.flush()
+        self.assertEqual(message_writer._pending, [])
+        self.assertEqual(await sync_to_async(self.stored_ids)(), [1000])
+        await message_writer.close()
+
+    async def test_close_flushes_everything_pending(self):
+        message_writer = self.make_writer(batch_size=100)
+        for i in range(3):
+            await message_writer.submit(self.user, self.room, f'm{i}')
+        await message_writer.close()
+        self.assertIsNone(message_writer._task)
+        self.assertEqual(await sync_to_async(self.stored_ids)(), [1000, 1001, 1002])
+
+    def test_colliding_id_is_dropped_not_rekeyed(self):
+        Message.objects.create(id=1000, user=self.user, room=self.room, content='taken')
+        batch = [
+            Message(id=1000, user=self.user, room=self.room, content='broadcast'),
+            Message(id=1001, user=self.user, room=self.room, content='fine'),
+        ]
+        with self.assertLogs('core.writer', 'ERROR'):
+            writer.persist_batch(batch)
+        self.assertEqual(
+            list(Message.objects.order_by('id').values_list('id', 'content')),
+            [(1000, 'taken'), (1001, 'fine')],
+        )
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_saved_messages_take_ids_from_the_counter(self):
+        with mock.patch.object(writer, 'next_message_id', return_value=1500):
+            message = Message.objects.create(user=self.user, room=self.room, content='from the api')
+        self.assertEqual(message.id, 1500)
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_read_cursor_stops_below_unflushed_ids(self):
+        with mock.patch.object(writer, 'read_horizon', return_value=1004):
+            timeline.mark_read(self.user.id, self.room.id, 1009)
+        self.assertEqual(timeline.get_read_cursor(self.user.id, self.room.id), 1004)
+
+
+class ConsumerHistoryTests(ConsumerTestCase):
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=3)
+    async def test_history_pages_walk_back_from_the_newest(self):
+        ids = [await sync_to_async(self.post)(f'm{i}') for i in range(5)]
+        communicator = await self.connect()
+        first = (await self.frames(communicator, until='chat_history'))[0]
+        self.assertEqual([row['id'] for row in first['history']], ids[2:])
+        self.assertTrue(first['has_more'])
+
+        await communicator.send_to(text_data=json.dumps({'type': 'history', 'before': first['cursor']}))
+        page = (await self.frames(communicator, until='chat_history_page'))[-1]
+        self.assertEqual([row['id'] for row in page['history']], ids[:2])
+        self.assertFalse(page['has_more'])
+        await communicator.disconnect()
+
+    @override_settings(CHAT_CATCHUP_LIMIT=2)
+    async def test_catch_up_from_the_read_cursor(self):
+        ids = [await sync_to_async(self.post)(f'm{i}') for i in range(5)]
+        await sync_to_async(timeline.mark_read)(self.user.id, self.room.id, ids[0])
+        communicator = await self.connect()
+        frames = await self.frames(communicator, until='chat_catchup')
+        self.assertEqual([frame['type'] for frame in frames], ['chat_history', 'chat_catchup'])
+        self.assertEqual([row['id'] for row in frames[0]['history']], ids[:1])
+        self.assertEqual([row['id'] for row in frames[1]['history']], ids[1:3])
+        self.assertTrue(frames[1]['has_more'])
+
+        caught_up = frames[1]['history']
+        while frames[-1]['has_more']:
+            await communicator.send_to(text_data=json.dumps({'type': 'history', 'after': frames[-1]['next_cursor']}))
+            frames = await self.frames(communicator, until='chat_catchup')
+            caught_up += frames[-1]['history']
+        self.assertEqual([row['id'] for row in caught_up], ids[1:])
+        await communicator.disconnect()
+        self.assertEqual(await sync_to_async(timeline.get_read_cursor)(self.user.id, self.room.id), ids[-1])
+
+    async def test_msgpack_clients_get_short_keys(self):
+        communicator = await self.connect(subprotocols=[protocol.MSGPACK_SUBPROTOCOL])
+        output = await communicator.receive_output(timeout=5)
+        self.assertEqual(msgpack.unpackb(output['bytes'])['t'], 'chat_history')
+        await self.frames(communicator, until='session')
+
+        await communicator.send_to(bytes_data=msgpack.packb({'m': 'hi', 'ts': 'now'}))
+        # A members_joined broadcast for alice may still be on its way
+        while (message := msgpack.unpackb((await communicator.receive_output(timeout=5))['bytes']))['t'] != 'chat_message':
+            pass
+        self.assertEqual((message['m'], message['u'], message['ts']), ('hi', 'alice', 'now'))
+        await communicator.disconnect()
+
+
+class PresenceFrameTests(ConsumerTestCase):
+    async def test_presence_reports_users_connected_anywhere(self):
+        with mock.patch('core.presence.online_in_room', mock.AsyncMock(return_value=[self.user.id])), \
+                mock.patch('core.presence.connected_users', mock.AsyncMock(return_value=[7])) as connected:
+            communicator = await self.connect()
+            await self.frames(communicator, until='session')
+            await communicator.send_to(text_data=json.dumps({'type': 'presence', 'users': [7, 8, 'x', True]}))
+            frame = (await self.frames(communicator, until='presence'))[-1]
+            await communicator.disconnect()
+        self.assertEqual(frame, {'type': 'presence', 'online': [self.user.id], 'connected': [7]})
+        self.assertEqual(connected.await_args.args[0], {7, 8})
+
+
+class PresenceFailureTests(ConsumerTestCase):
+    async def test_connection_survives_a_presence_outage(self):
+        outage = mock.AsyncMock(side_effect=ConnectionError('redis down'))
+        with mock.patch('core.presence.touch', outage), mock.patch('core.presence.leave', outage):
+            with self.assertLogs('core.consumers', 'WARNING'):
+                communicator = await self.connect()
+                frames = await self.frames(communicator, until='session')
+                await communicator.disconnect()
+        self.assertEqual([frame['type'] for frame in frames], ['chat_history', 'session'])
+
+
+class ReadCursorTests(ConsumerTestCase):
+    def read_cursor(self):
+        return timeline.get_read_cursor(self.user.id, self.room.id)
+
+    async def test_cursor_moves_once_the_view_is_sent(self):
+        ids = [await sync_to_async(self.post)(f'm{i}') for i in range(3)]
+        communicator = await self.connect()
+        await self.frames(communicator, until='session')
+        await communicator.disconnect()
+        self.assertEqual(await sync_to_async(self.read_cursor)(), ids[-1])
+
+    async def test_cursor_stays_when_nothing_was_sent(self):
+        first = await sync_to_async(self.post)('read')
+        await sync_to_async(timeline.mark_read)(self.user.id, self.room.id, first)
+        await sync_to_async(self.post)('unread')
+
+        async def stalled(consumer):
+            await asyncio.Event().wait()
+
+        with mock.patch('core.consumers.ChatConsumer.sender', stalled):
+            communicator = await self.connect()
+            await communicator.disconnect()
+        self.assertEqual(await sync_to_async(self.read_cursor)(), first)
+
+
+class FrameLimitTests(ConsumerTestCase):
+    async def send_to_room(self, communicator):
+        await communicator.send_to(text_data=json.dumps({'message': 'hi', 'timestamp': ''}))
+
+    @override_settings(CHAT_MAX_FRAME_BYTES=64)
+    async def test_oversized_frame_closes_the_socket(self):
+        communicator = await self.connect()
+        await self.frames(communicator, until='session')
+        await communicator.send_to(text_data=json.dumps({'message': 'x' * 100}))
+        frames = await self.frames(communicator)
+        self.assertEqual(frames[0]['type'], 'error')
+        self.assertEqual(frames[-1], {'type': 'websocket.close', 'code': protocol.CLOSE_TOO_LARGE})
+        self.assertEqual(await sync_to_async(Message.objects.count)(), 0)
+
+    async def test_malformed_frames_get_an_error_and_store_nothing(self):
+        communicator = await self.connect(subprotocols=[protocol.MSGPACK_SUBPROTOCOL])
+        await self.frames(communicator, until='session')
+        for frame in ({'text_data': '[1, 2]'}, {'text_data': '{"message"'},
+                      {'bytes_data': msgpack.packb({'m': 5})}, {'bytes_data': msgpack.packb({'m': b'x'})}):
+            with self.subTest(frame=frame):
+                await communicator.send_to(**frame)
+                self.assertEqual((await self.frames(communicator, until='error'))[-1]['type'], 'error')
+        # The connection is still usable
+        await communicator.send_to(bytes_data=msgpack.packb({'m': 'hi'}))
+        self.assertEqual((await self.frames(communicator, until='chat_message'))[-1]['message'], 'hi')
+        await communicator.disconnect()
+        self.assertEqual(await sync_to_async(Message.objects.count)(), 1)
+
+    @override_settings(CHAT_SEND_QUEUE_SIZE=2)
+    async def test_client_is_dropped_when_its_outbox_is_full(self):
+        async def stalled(consumer):
+            await asyncio.Event().wait()
+
+        # Nothing leaves the outbox: history and session fill it on connect
+        with mock.patch('core.consumers.ChatConsumer.sender', stalled):
+            communicator = await self.connect()
+            await self.send_to_room(communicator)
+            frames = await self.frames(communicator)
+        self.assertEqual(frames, [{'type': 'websocket.close', 'code': protocol.CLOSE_TRY_AGAIN_LATER}])
+
+    @override_settings(CHAT_MAX_UNACKED=2)
+    async def test_client_is_dropped_when_too_far_past_its_ack(self):
+        communicator = await self.connect()
+        await self.frames(communicator, until='session')
+        await communicator.send_to(text_data=json.dumps({'type': 'ack', 'id': 0}))
+        for i in range(2):
+            await self.send_to_room(communicator)
+            await self.frames(communicator, until='chat_message')
+        await self.send_to_room(communicator)
+        frames = await self.frames(communicator)
+        self.assertEqual(frames, [{'type': 'websocket.close', 'code': protocol.CLOSE_TRY_AGAIN_LATER}])
+        await communicator.disconnect()
+        # Nothing past the ack counts as read
+        self.assertEqual(await sync_to_async(timeline.get_read_cursor)(self.user.id, self.room.id), 0)
+
+    @override_settings(CHAT_MAX_UNACKED=2)
+    async def test_acked_client_is_not_dropped(self):
+        communicator = await self.connect()
+        await self.frames(communicator, until='session')
+        for i in range(4):
+            await self.send_to_room(communicator)
+            frames = await self.frames(communicator, until='chat_message')
+            await communicator.send_to(text_data=json.dumps({'type': 'ack', 'id': frames[-1]['id']}))
+        self.assertEqual(await self.frames(communicator), [])
+        await communicator.disconnect()
+        self.assertEqual(
+            await sync_to_async(timeline.get_read_cursor)(self.user.id, self.room.id), frames[-1]['id'],
+        )
+
+
+class WorkerConnections:
+    """The connection count hash of ``core.workers``, held in memory."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    async def hincrby(self, key, field, delta):
+        counts = self.hashes.setdefault(key, {})
+        counts[field.encode()] = counts.get(field.encode(), 0) + delta
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+
+@override_settings(CHAT_WORKER_ID='w1', CHAT_RECONNECT_JITTER=0)
+class WorkerDrainTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = WorkerConnections()
+        patcher = mock.patch('core.workers.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, workers, 'draining', False)
+
+    async def test_draining_worker_refuses_new_connections(self):
+        workers.draining = True
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.room.name}/{self.user.id}/')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(workers.connection_counts(self.redis), {})
+
+    async def test_server_drain_asks_clients_to_reconnect_elsewhere(self):
+        communicator = await self.connect()
+        await self.frames(communicator, until='session')
+        await get_channel_layer().group_send(workers.worker_group('w1'), {'type': 'server_drain', 'window': 0})
+        frames = await self.frames(communicator, until='reconnect')
+        self.assertEqual(frames[-1], {'type': 'reconnect', 'retry_after': 0})
+        self.assertEqual(await communicator.receive_output(timeout=5),
+                         {'type': 'websocket.close', 'code': protocol.CLOSE_SERVICE_RESTART})
+        self.assertTrue(workers.draining)
+        await communicator.disconnect()
+
+    async def test_connections_are_counted_per_worker(self):
+        first = await self.connect()
+        second = await self.connect()
+        self.assertEqual(workers.connection_counts(self.redis), {'w1': 2})
+        await first.disconnect()
+        self.assertEqual(workers.connection_counts(self.redis), {'w1': 1})
+        await second.disconnect()
+        self.assertEqual(workers.connection_counts(self.redis), {'w1': 0})
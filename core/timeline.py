@@ -0,0 +1,196 @@
+"""
+Append-only message timeline for chat rooms.
+
+Every message is written exactly once, as a single ``Message`` row. A user's
+view of a room is the room timeline combined with that user's ``ReadCursor``,
+so posting a message costs one insert regardless of room size or history
+length.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from . import archive
+from .models import Message, ReadCursor
+
+HISTORY_VERSION_KEY = 'chat:history:version:{}'
+
+
+def append_message(user, room, content):
+    return Message.objects.create(user=user, room=room, content=content)
+
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'message': message.content,
+        'username': message.user.username,
+        'user_id': message.user_id,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def fetch_page(room_id, before=None, after=None, limit=None):
+    """
+    Return serialized messages of a room, oldest first.
+
+    ``before``/``after`` are exclusive message ids. Without ``after`` the page
+    ends at the newest message (or just before ``before``); with ``after`` it
+    starts right after that id. Pages reaching past the oldest message in
+    ``Message`` continue into the archive.
+    """
+    messages = (
+        Message.objects.filter(room_id=room_id)
+        .select_related('user')
+        .only('id', 'content', 'timestamp', 'user_id', 'user__username')
+    )
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    if after is not None:
+        # Archived ids all precede the hot ones, so the archive comes first
+        rows = archive.fetch_after(room_id, after, limit)
+        if before is not None:
+            rows = [row for row in rows if row['id'] < before]
+        if len(rows) < limit:
+            start = rows[-1]['id'] if rows else after
+            rows += [
+                serialize_message(message)
+                for message in messages.filter(id__gt=start).order_by('id')[:limit - len(rows)]
+            ]
+        return rows
+
+    hot = list(messages.order_by('-id')[:limit])
+    hot.reverse()
+    rows = [serialize_message(message) for message in hot]
+    if len(rows) < limit:
+        end = rows[0]['id'] if rows else before
+        rows = archive.fetch_before(room_id, end, limit - len(rows)) + rows
+    return rows
+
+
+def clamp_limit(value, default=None):
+    """Parse a client supplied page size, bounded by ``CHAT_HISTORY_MAX_PAGE_SIZE``."""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        limit = default or settings.CHAT_HISTORY_PAGE_SIZE
+    return max(1, min(limit, settings.CHAT_HISTORY_MAX_PAGE_SIZE))
+
+
+def history_page(room_id, before=None, after=None, limit=None):
+    """
+    Return one keyset page of a room's history.
+
+    Pages walk backwards from ``before`` (or the newest message) unless
+    ``after`` is given, in which case they walk forwards. ``cursor`` is the id
+    to pass as ``before`` for the next older page, ``next_cursor`` the id to
+    pass as ``after`` for the next newer one; ``has_more`` refers to the
+    direction being walked.
+    """
+    limit = limit or settings.CHAT_HISTORY_PAGE_SIZE
+    # One extra row tells us whether another page exists
+    rows = fetch_page(room_id, before=before, after=after, limit=limit + 1)
+    has_more = len(rows) > limit
+    if has_more:
+        rows = rows[:limit] if after is not None else rows[1:]
+    return {
+        'history': rows,
+        'cursor': rows[0]['id'] if rows else None,
+        'next_cursor': rows[-1]['id'] if rows else None,
+        'has_more': has_more,
+    }
+
+
+def user_view(room_id, user_id, limit=None, catchup_limit=None):
+    """
+    Build a user's view of a room on connect from their read cursor.
+
+    ``history`` is the page of messages up to and including the cursor and
+    ``unread`` the messages after it, oldest first, fetched in one bounded range
+    query; if ``unread['has_more']`` the client pages on with ``after``. The
+    cursor is left alone: the caller moves it once the messages are sent.
+    """
+    cursor = get_read_cursor(user_id, room_id)
+    if cursor:
+        history = history_page(room_id, before=cursor + 1, limit=limit)
+        unread = history_page(room_id, after=cursor, limit=catchup_limit or settings.CHAT_CATCHUP_LIMIT)
+    else:
+        # First visit: nothing is unread yet, start from the newest page
+        history = history_page(room_id, limit=limit)
+        unread = {'history': [], 'cursor': None, 'next_cursor': None, 'has_more': False}
+    return history, unread
+
+
+def history_version(room_id):
+    """
+    When a room's existing messages last changed (edited, deleted or archived),
+    in milliseconds. New messages are covered by the room's latest id instead.
+    """
+    key = HISTORY_VERSION_KEY.format(room_id)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so a version lost to eviction is never reused
+        version = int(time.time() * 1000)
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def invalidate_history(room_id):
+    """Retire cached copies of a room's history once the current transaction commits."""
+    transaction.on_commit(lambda: _bump_history_version(room_id))
+
+
+def _bump_history_version(room_id):
+    key = HISTORY_VERSION_KEY.format(room_id)
+    cache.set(key, max(int(time.time() * 1000), (cache.get(key) or 0) + 1), None)
+
+
+def parse_message_id(value):
+    """Parse a client supplied message id cursor, ignoring junk."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+def latest_message(room_id):
+    """Return ``(id, timestamp)`` of the newest message in a room, or ``None``."""
+    return (
+        Message.objects.filter(room_id=room_id)
+        .order_by('-id')
+        .values_list('id', 'timestamp')
+        .first()
+    ) or archive.latest(room_id)
+
+
+def get_read_cursor(user_id, room_id):
+    cursor = ReadCursor.objects.filter(user_id=user_id, room_id=room_id).values_list('last_read_id', flat=True).first()
+    return cursor or 0
+
+
+def mark_read(user_id, room_id, message_id):
+    """
+    Move the user's cursor forward to ``message_id``; cursors never move back.
+
+    With write-behind on, the cursor stops short of the lowest id not yet
+    written, so a reconnect still reads messages that were in flight.
+    """
+    if message_id and settings.CHAT_WRITE_BEHIND:
+        from .writer import read_horizon
+        horizon = read_horizon()
+        if horizon is not None:
+            message_id = min(message_id, horizon)
+    if not message_id:
+        return
+    updated = ReadCursor.objects.filter(
+        user_id=user_id, room_id=room_id, last_read_id__lt=message_id
+    ).update(last_read_id=message_id, updated=timezone.now())
+    if not updated:
+        ReadCursor.objects.get_or_create(
+            user_id=user_id, room_id=room_id, defaults={'last_read_id': message_id}
+        )
@@ -1,18 +1,87 @@
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.response import Response
 from .models import ChatRoom, Message, UserChatActivity, ChatHistory
-from .serializers import ChatRoomSerializer, MessageSerializer, UserChatActivitySerializer, ChatHistorySerializer
+from .serializers import ChatRoomSerializer, MemberIdsSerializer, MessageSerializer, UserChatActivitySerializer, ChatHistorySerializer
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
-from django.http import JsonResponse
-from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import condition, require_GET
+from . import membership, metrics, search, timeline
+from .pagination import IdCursorPagination
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
     queryset = ChatRoom.objects.all()
     serializer_class = ChatRoomSerializer
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        # A count per room instead of serializing every member
+        return ChatRoom.objects.annotate(member_count=Count('users'))
+
+    def list(self, request, *args, **kwargs):
+        # Cached per user and query string; membership and room changes bump the version
+        key = 'chat:rooms:{}:{}:{}'.format(
+            request.user.id, membership.room_list_version(), request.query_params.urlencode(),
+        )
+        data = cache.get(key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(key, data, settings.ROOM_LIST_CACHE_TTL)
+        return Response(data)
+
+    @action(detail=True, methods=['get'])
+    def search(self, request, pk=None):
+        # Only members may search a room's messages
+        room = self.get_object()
+        if not room.users.filter(id=request.user.id).exists():
+            raise PermissionDenied('You are not a member of this room.')
+        return Response(search.search_messages(
+            room.id,
+            request.query_params.get('q', ''),
+            before=timeline.parse_message_id(request.query_params.get('before')),
+            limit=timeline.clamp_limit(request.query_params.get('limit')),
+        ))
+
+    @action(detail=True, methods=['post'], url_path='members/add')
+    def add_members(self, request, pk=None):
+        # {"user_ids": [...]}: one INSERT batch set and one members_joined announcement
+        added = membership.add_members(self.get_object(), self._member_ids(request))
+        return Response({'added': [user_id for user_id, _ in added]})
+
+    @action(detail=True, methods=['post'], url_path='members/remove')
+    def remove_members(self, request, pk=None):
+        removed = membership.remove_members(self.get_object(), self._member_ids(request))
+        return Response({'removed': [user_id for user_id, _ in removed]})
+
+    def _member_ids(self, request):
+        serializer = MemberIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['user_ids']
 
 class MessageViewSet(viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = Message.objects.all()
+        room = self.request.query_params.get('room')
+        if room is not None and self.action == 'list':
+            if not room.isdigit():
+                raise ValidationError({'room': 'Expected a room id.'})
+            # Walks core_message_room_id_idx newest first
+            queryset = queryset.filter(room_id=int(room))
+        return queryset
 
 class UserActivityViewSet(viewsets.ModelViewSet):
     queryset = UserChatActivity.objects.all()
@@ -29,20 +98,66 @@ def chat_room(request, room_name, user_id):
     })
 
 
+def _history_state(request, room_name):
+    # Resolved once per request and shared by the ETag/Last-Modified checks and the view
+    if not hasattr(request, '_chat_history_state'):
+        room_id = ChatRoom.objects.filter(name=room_name).values_list('id', flat=True).first()
+        latest = timeline.latest_message(room_id) if room_id else None
+        version = timeline.history_version(room_id) if room_id else None
+        request._chat_history_state = (room_id, latest, version)
+    return request._chat_history_state
+
+
+def _history_etag(request, room_name, user_id):
+    room_id, latest, version = _history_state(request, room_name)
+    if room_id is None:
+        return None
+    # A page changes when a newer message lands in the room or an existing
+    # one is edited, deleted or archived
+    return '"{}-{}-{}-{}-{}-{}"'.format(
+        room_id,
+        latest[0] if latest else 0,
+        version,
+        request.GET.get('before', ''),
+        request.GET.get('after', ''),
+        request.GET.get('limit', ''),
+    )
+
+
+def _history_last_modified(request, room_name, user_id):
+    room_id, latest, version = _history_state(request, room_name)
+    if room_id is None:
+        return None
+    changed = datetime.datetime.fromtimestamp(version / 1000, tz=datetime.timezone.utc)
+    return max(latest[1], changed) if latest else changed
+
+
+@require_GET
+@condition(etag_func=_history_etag, last_modified_func=_history_last_modified)
 def chat_history(request, room_name, user_id):
     try:
-        # Fetch messages for the room and optionally filter by user_id
-        messages = Message.objects.filter(room__name=room_name).order_by('timestamp')
-        history = [{
-            'username': msg.user.username,  # Assuming `user` is a ForeignKey to Django's User model
-            'message': msg.content,
-            'timestamp': msg.timestamp
-        } for msg in messages]
-
-        return JsonResponse({'history': history}, status=200)
-    except ObjectDoesNotExist:
-        return JsonResponse({'error': 'Messages not found'}, status=404)
-    except Exception as e:
-        print(f"Error fetching chat history: {e}")
+        room_id, _, _ = _history_state(request, room_name)
+        if room_id is None:
+            return JsonResponse({'error': 'Room not found'}, status=404)
+
+        limit = timeline.clamp_limit(request.GET.get('limit'))
+        page = timeline.history_page(
+            room_id,
+            before=timeline.parse_message_id(request.GET.get('before')),
+            after=timeline.parse_message_id(request.GET.get('after')),
+            limit=limit,
+        )
+        return JsonResponse(page, status=200)
+    except Exception:
+        logger.exception("error fetching chat history room=%s", room_name)
         return JsonResponse({'error': 'Internal Server Error'}, status=500)
 
+
+@require_GET
+def metrics_view(request):
+    # Closed by default: scrapers send METRICS_TOKEN as a bearer token, people log in as staff
+    token = settings.METRICS_TOKEN
+    scraper = bool(token) and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not scraper and not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,55 @@
+"""
+Worker bookkeeping for ``manage.py runworkers``.
+
+Every Daphne process started by ``runworkers`` gets a unique
+``CHAT_WORKER_ID``. Its consumers then:
+
+- join the ``chat_worker_<id>`` group, so the launcher can ask exactly that
+  process's connections to leave before stopping it;
+- count themselves in the ``chat:workers:connections`` Redis hash, one field
+  per worker, which the launcher reads to know when a drain is done.
+
+Processes started without a worker id (plain ``daphne``) skip both.
+"""
+import logging
+
+from django.conf import settings
+
+from .metrics import REDIS_CALL
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+CONNECTIONS_KEY = 'chat:workers:connections'
+
+# Set once this process has been asked to drain; new sockets are turned away
+draining = False
+
+
+def worker_group(worker_id):
+    return f'chat_worker_{worker_id}'
+
+
+async def connection_opened():
+    await _count(1)
+
+
+async def connection_closed():
+    await _count(-1)
+
+
+async def _count(delta):
+    try:
+        with REDIS_CALL.time(operation='worker_count'):
+            await get_redis().hincrby(CONNECTIONS_KEY, settings.CHAT_WORKER_ID, delta)
+    except Exception as e:
+        # Accounting only steers drains; never fail a connection over it
+        logger.warning("worker connection count failed worker=%s: %s", settings.CHAT_WORKER_ID, e)
+
+
+def connection_counts(client):
+    """Open connections per worker id, read with a synchronous Redis ``client``."""
+    return {
+        key.decode(): int(value)
+        for key, value in client.hgetall(CONNECTIONS_KEY).items()
+    }
@@ -0,0 +1,347 @@
+"""
+Write-behind persistence for chat messages.
+
+With ``CHAT_WRITE_BEHIND`` enabled the consumer no longer waits for a database
+commit per message. Each message gets its id from a Redis counter, is broadcast
+immediately and is queued here; a background task flushes the queue to
+``Message`` with ``bulk_create`` every ``CHAT_WRITE_BEHIND_FLUSH_INTERVAL``
+seconds or whenever ``CHAT_WRITE_BEHIND_BATCH_SIZE`` messages are waiting.
+
+The counter is then the only source of message ids: ``Message.save`` takes one
+from it too, so rows written by the REST API or the admin can never collide
+with a broadcast id. Ids handed out but not yet flushed are kept in the
+``chat:message_id:pending`` sorted set; read cursors are never moved past the
+lowest of them (``read_horizon``), and connects wait for them to be written
+(``wait_flushed``) before reading history.
+
+At most ``CHAT_WRITE_BEHIND_MAX_PENDING`` messages are buffered; beyond that
+``submit`` blocks until a flush frees room. Daphne does not speak the ASGI
+lifespan protocol, so pending messages are flushed from a Twisted shutdown
+trigger when running under Daphne, on lifespan shutdown under servers that
+have it, and at interpreter exit as a last resort. Until a message is flushed
+it is not visible to history reads.
+"""
+import asyncio
+import atexit
+import logging
+import sys
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .db import db_sync_to_async
+from .models import Message
+from .redis_pool import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_ID_KEY = 'chat:message_id'
+PENDING_KEY = 'chat:message_id:pending'
+
+# Raise the id counter to at least ARGV[1]; never lowers it
+RAISE_COUNTER = """
+local current = tonumber(redis.call('get', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('set', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# Next id, or nil while the counter is unseeded. With KEYS[2] the id is also
+# recorded as pending, member "<id>:<expiry>" scored by id
+NEXT_ID = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+local id = redis.call('incr', KEYS[1])
+if KEYS[2] then
+    redis.call('zadd', KEYS[2], id, id .. ':' .. ARGV[1])
+end
+return id
+"""
+
+# Lowest pending id, or 0; entries past their expiry (ARGV[1]) are dropped
+LOWEST_PENDING = """
+while true do
+    local first = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+    if #first == 0 then
+        return 0
+    end
+    local expires = tonumber(string.match(first[1], ':(%d+)$'))
+    if expires >= tonumber(ARGV[1]) then
+        return tonumber(first[2])
+    end
+    redis.call('zrem', KEYS[1], first[1])
+end
+"""
+
+
+def _max_message_id():
+    return Message.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+
+
+def _sync_sequence():
+    # Postgres hands out ids from a sequence that explicit ids do not advance
+    if connection.vendor == 'postgresql':
+        table = Message._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                f"GREATEST((SELECT COALESCE(MAX(id), 1) FROM {connection.ops.quote_name(table)}), "
+                "nextval(pg_get_serial_sequence(%s, 'id'))))",
+                [table, table],
+            )
+
+
+def _pending_expiry():
+    return int(time.time()) + settings.CHAT_WRITE_BEHIND_PENDING_TTL
+
+
+def _pending_member(message):
+    return f'{message.id}:{message._pending_expires}'
+
+
+def next_message_id():
+    """Take an id for a message saved synchronously (REST API, admin)."""
+    client = get_sync_redis()
+    message_id = client.eval(NEXT_ID, 1, MESSAGE_ID_KEY)
+    if message_id is None:
+        client.eval(RAISE_COUNTER, 1, MESSAGE_ID_KEY, _max_message_id())
+        message_id = client.eval(NEXT_ID, 1, MESSAGE_ID_KEY)
+    return message_id
+
+
+def read_horizon():
+    """Highest id a read cursor may be moved to, or ``None`` if nothing is pending."""
+    try:
+        lowest = get_sync_redis().eval(LOWEST_PENDING, 1, PENDING_KEY, int(time.time()))
+    except Exception as e:
+        # Unknown: keep cursors where they are rather than risk skipping messages
+        logger.warning("reading unflushed message ids failed: %s", e)
+        return 0
+    return lowest - 1 if lowest else None
+
+
+def persist_batch(batch):
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+    except IntegrityError:
+        # The message was broadcast under its id already, so it cannot be given
+        # another one; a collision means a row was written with an id that did
+        # not come from the counter
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    message.save(force_insert=True)
+            except IntegrityError:
+                logger.error(
+                    "message id=%s room=%s collides with an existing row; dropping it",
+                    message.id, message.room_id,
+                )
+    _sync_sequence()
+    return _max_message_id()
+
+
+class MessageWriter:
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._task = None
+        self._ready = None
+        self._wakeup = None
+        self._space = None
+        self._flushed = None
+        self._flush_lock = None
+        self._closing = False
+
+    async def start(self):
+        if self._task is None:
+            self._closing = False
+            self._ready = asyncio.get_running_loop().create_future()
+            self._wakeup = asyncio.Event()
+            self._space = asyncio.Event()
+            self._space.set()
+            self._flushed = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+            self._flush_on_reactor_shutdown()
+        await asyncio.shield(self._ready)
+
+    async def submit(self, user, room, content):
+        """Assign an id to a new message and queue it for the next flush."""
+        await self.start()
+        # Backpressure: wait for the writer to catch up instead of growing the buffer
+        while len(self._pending) >= self.max_pending:
+            self._space.clear()
+            self._wakeup.set()
+            await self._space.wait()
+
+        expires = _pending_expiry()
+        message = Message(
+            id=await self._allocate_id(expires),
+            user=user,
+            room=room,
+            content=content,
+            timestamp=timezone.now(),
+        )
+        message._pending_expires = expires
+        self._pending.append(message)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return message
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:len(batch)]
+                try:
+                    max_id = await db_sync_to_async(persist_batch)(batch)
+                except Exception:
+                    # Put the batch back in front; the next flush retries it
+                    logger.exception("flushing %d messages failed", len(batch))
+                    self._pending[:0] = batch
+                    await self._hold(batch)
+                    return
+                if len(self._pending) < self.max_pending:
+                    self._space.set()
+                await self._release(batch)
+                await self._seed_counter(max_id)
+            self._flushed.set()
+
+    async def wait_flushed(self):
+        """
+        Wait until every id handed out so far, by any worker, is written.
+
+        Gives up after a few flush intervals; history read then may miss the
+        messages still in flight.
+        """
+        await self.start()
+        client = get_redis()
+        last_id = int(await client.get(MESSAGE_ID_KEY) or 0)
+        deadline = time.monotonic() + self.flush_interval * 4
+        while True:
+            lowest = await client.eval(LOWEST_PENDING, 1, PENDING_KEY, int(time.time()))
+            if not lowest or lowest > last_id:
+                return
+            if time.monotonic() >= deadline:
+                logger.warning("messages up to id=%s are still unflushed", last_id)
+                return
+            self._flushed.clear()
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._flushed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        """Stop the background task after a final flush of everything pending."""
+        if self._task is None:
+            return
+        # Not cancel(): a flush interrupted mid-insert would be written twice
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def flush_sync(self):
+        # Used at interpreter exit, when the event loop is already gone
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            persist_batch(batch)
+            del self._pending[:len(batch)]
+            try:
+                get_sync_redis().zrem(PENDING_KEY, *map(_pending_member, batch))
+            except Exception as e:
+                # The entries expire after CHAT_WRITE_BEHIND_PENDING_TTL anyway
+                logger.warning("releasing %d pending ids failed: %s", len(batch), e)
+
+    async def _run(self):
+        # Ids must not be handed out before the counter is above the table's ids
+        try:
+            await self._seed_counter(await db_sync_to_async(_max_message_id)())
+        except Exception as e:
+            self._task = None
+            self._ready.set_exception(e)
+            return
+        self._ready.set_result(None)
+
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    def _flush_on_reactor_shutdown(self):
+        # Daphne never sends lifespan.shutdown; its reactor waits for the
+        # Deferred returned by a 'before shutdown' trigger instead
+        reactor = sys.modules.get('twisted.internet.reactor')
+        if reactor is None or not hasattr(reactor, 'addSystemEventTrigger'):
+            return
+        from twisted.internet.defer import Deferred
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', lambda: Deferred.fromFuture(asyncio.ensure_future(self.close())),
+        )
+
+    async def _allocate_id(self, expires):
+        client = get_redis()
+        message_id = await client.eval(NEXT_ID, 2, MESSAGE_ID_KEY, PENDING_KEY, expires)
+        if message_id is None:
+            # The counter was lost (Redis restarted empty); reseed it from the table
+            await self._seed_counter(await db_sync_to_async(_max_message_id)())
+            message_id = await client.eval(NEXT_ID, 2, MESSAGE_ID_KEY, PENDING_KEY, expires)
+        return message_id
+
+    async def _release(self, batch):
+        try:
+            await get_redis().zrem(PENDING_KEY, *map(_pending_member, batch))
+        except Exception as e:
+            # The entries expire after CHAT_WRITE_BEHIND_PENDING_TTL anyway
+            logger.warning("releasing %d pending ids failed: %s", len(batch), e)
+
+    async def _hold(self, batch):
+        # Keep a batch that failed to flush holding back cursors past its expiry
+        expires = _pending_expiry()
+        try:
+            async with get_redis().pipeline(transaction=True) as pipe:
+                pipe.zrem(PENDING_KEY, *map(_pending_member, batch))
+                pipe.zadd(PENDING_KEY, {f'{message.id}:{expires}': message.id for message in batch})
+                await pipe.execute()
+        except Exception as e:
+            logger.warning("renewing %d pending ids failed: %s", len(batch), e)
+            return
+        for message in batch:
+            message._pending_expires = expires
+
+    async def _seed_counter(self, max_id):
+        # Keep Redis ids ahead of rows inserted without the writer
+        await get_redis().eval(RAISE_COUNTER, 1, MESSAGE_ID_KEY, max_id)
+
+
+_writer = None
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(
+            batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+            max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+        )
+    return _writer
+
+
+@atexit.register
+def _flush_at_exit():
+    if _writer is not None and _writer._pending:
+        _writer.flush_sync()